@@ -48,11 +48,21 @@ Options:
                                     multiplying by 1./normK.
   --algorithm=<string>              Which algorithm to run [default: spdhg]
   --numThreads=<int>                Number of threads to use
+  --numReadThreads=<int>            Number of input files read concurrently
+                                    [default: 4]
+  --numNormWorkers=<int>            Number of processes computing the norms of
+                                    the blocks for spdhg (default: one per block
+                                    up to --numThreads)
   --numSubsets=<int>                Number of physical subsets to use [default: 1]
   --gamma=<val>                     parameter controlling primal-dual trade-off (>1 promotes dual)
                                     [default: 1.]
   --PowerMethod_iters=<val>         number of iterations for the computation of operator norms
                                     with the power method [default: 10]
+  --PowerMethod_tol=<val>           relative change of the operator norm estimates
+                                    at which the power method stops early
+                                    (0 runs all iterations) [default: 0]
+  --PowerMethod_lanczos             Use the Lanczos iteration instead of the
+                                    power method for operator norms
   --templateAcqData                 Use template acd data
   --StorageSchemeMemory             Use memory storage scheme
 """
@@ -75,9 +85,15 @@ Options:
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 from functools import partial
 from os import path
+import hashlib
+import json
+import multiprocessing
 import os
+import socket
+import time
 from glob import glob
 from docopt import docopt
 import matplotlib.pyplot as plt
@@ -140,8 +156,14 @@ def main():
     [trans, sinos_raw, attns, rands_raw] = \
         read_files(trans_files, sino_files, attn_files, rand_files, args['--trans_type'])
 
+    # randoms first, as they adopt the headers of the raw sinograms
+    rands = pre_process_sinos(rands_raw, num_ms, templates=sinos_raw)
     sinos = pre_process_sinos(sinos_raw, num_ms)
-    rands = pre_process_sinos(rands_raw, num_ms)
+    del sinos_raw, rands_raw
+    # zero randoms if none are given (rather than the small background
+    # that the reconstructors use without randoms)
+    if not rands:
+        rands = [sino * 0 for sino in sinos]
 
     ###########################################################################
     # Initialise recon image
@@ -250,69 +272,121 @@ def get_filenames(trans, sino, attn, rand):
 
 def read_files(trans_files, sino_files, attn_files, rand_files, trans_type):
     """Read files."""
-    if trans_files == []:
-        trans = None
-    else:
+    read_trans = None
+    if trans_files != []:
         if trans_type == "tm":
-            trans = [reg.AffineTransformation(file) for file in trans_files]
+            read_trans = reg.AffineTransformation
         elif trans_type == "disp":
-            trans = [reg.NiftiImageData3DDisplacement(file)
-                     for file in trans_files]
+            read_trans = reg.NiftiImageData3DDisplacement
         elif trans_type == "def":
-            trans = [reg.NiftiImageData3DDeformation(file)
-                     for file in trans_files]
+            read_trans = reg.NiftiImageData3DDeformation
         else:
             raise error("Unknown transformation type")
 
-    sinos_raw = [pet.AcquisitionData(file) for file in sino_files]
-    attns = [pet.ImageData(file) for file in attn_files]
-    
-    # fix a problem with the header which doesn't allow
-    # to do algebra with randoms and sinogram
-    rands_arr = [pet.AcquisitionData(file).as_array() for file in rand_files]
-    rands_raw = [ s * 0 for s in sinos_raw ]
-    for r,a in zip(rands_raw, rands_arr):
-        r.fill(a)
-    
+    # all files are read concurrently
+    loaded = load_files(
+        [(read_trans, file) for file in trans_files] +
+        [(pet.AcquisitionData, file) for file in sino_files] +
+        [(pet.ImageData, file) for file in attn_files] +
+        [(pet.AcquisitionData, file) for file in rand_files])
+    num_trans = len(trans_files)
+    num_sinos = len(sino_files)
+    num_attns = len(attn_files)
+    trans = loaded[:num_trans] if num_trans > 0 else None
+    sinos_raw = loaded[num_trans:num_trans + num_sinos]
+    attns = loaded[num_trans + num_sinos:num_trans + num_sinos + num_attns]
+    # the headers of the randoms are fixed by pre_process_sinos
+    rands_raw = loaded[num_trans + num_sinos + num_attns:]
+
     return [trans, sinos_raw, attns, rands_raw]
 
 
+def load_files(jobs):
+    """Read files concurrently.
+
+    jobs is a list of (reader, filename); the objects read are returned in
+    the same order. At most --numReadThreads files are read at a time. The
+    first failure cancels the reads that have not started and is raised."""
+    if not jobs:
+        return []
+    num_read_threads = max(1, min(int(args['--numReadThreads']), len(jobs)))
+
+    def load(reader, filename):
+        start = time.time()
+        obj = reader(filename)
+        print("Read {} in {:.2f} s".format(filename, time.time() - start))
+        return obj
 
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=num_read_threads) as executor:
+        futures = [executor.submit(load, reader, filename)
+                   for reader, filename in jobs]
+        done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in pending:
+            future.cancel()
+        for future, (reader, filename) in zip(futures, jobs):
+            if future in done and future.exception() is not None:
+                print("Failed to read {}".format(filename))
+                raise future.exception()
+    print("Read {} files in {:.2f} s with {} threads".format(
+        len(jobs), time.time() - start, num_read_threads))
+    return [future.result() for future in futures]
 
-def pre_process_sinos(sinos_raw, num_ms):
+
+
+
+def pre_process_sinos(sinos_raw, num_ms, templates=None):
     """Preprocess raw sinograms.
 
-    Make positive if necessary and do any required rebinning."""
+    Adopt the headers of templates (if given), make positive if necessary
+    and do any required rebinning, with at most one copy of the data of
+    each sinogram. Raw sinograms are modified in place and released from
+    sinos_raw as they are processed."""
     # If empty (e.g., no randoms), return
     if not sinos_raw:
         return sinos_raw
+    segs_to_combine = 1
+    if args['--numSegsToCombine']:
+        segs_to_combine = int(args['--numSegsToCombine'])
+    views_to_combine = 1
+    if args['--numViewsToCombine']:
+        views_to_combine = int(args['--numViewsToCombine'])
+    # bytes of the sinogram copies made by the former implementation
+    # (clone before clipping and a second as_array() for randoms) that are
+    # not made here
+    bytes_saved = 0
     # Loop over all sinograms
     sinos = [0]*num_ms
     for ind in range(num_ms):
+        sino = sinos_raw[ind]
+        sinos_raw[ind] = None
+        sino_arr = sino.as_array()
         # If any sinograms contain negative values
         # (shouldn't be the case), set them to 0
-        sino_arr = sinos_raw[ind].as_array()
-        if (sino_arr < 0).any():
+        negative = sino_arr.min() < 0
+        if negative:
             print("Input sinogram " + str(ind) +
                   " contains -ve elements. Setting to 0...")
-            sinos[ind] = sinos_raw[ind].clone()
-            sino_arr[sino_arr < 0] = 0
-            sinos[ind].fill(sino_arr)
-        else:
-            sinos[ind] = sinos_raw[ind]
+            np.maximum(sino_arr, 0, out=sino_arr)
+            bytes_saved += sino_arr.nbytes
+        if templates is not None:
+            # fix a problem with the header which doesn't allow
+            # to do algebra with randoms and sinogram
+            sino = pet.AcquisitionData(templates[ind])
+            bytes_saved += sino_arr.nbytes
+        if negative or templates is not None:
+            sino.fill(sino_arr)
+        del sino_arr
         # If rebinning is desired
-        segs_to_combine = 1
-        if args['--numSegsToCombine']:
-            segs_to_combine = int(args['--numSegsToCombine'])
-        views_to_combine = 1
-        if args['--numViewsToCombine']:
-            views_to_combine = int(args['--numViewsToCombine'])
         if segs_to_combine * views_to_combine > 1:
-            sinos[ind] = sinos[ind].rebin(segs_to_combine, views_to_combine)
+            sino = sino.rebin(segs_to_combine, views_to_combine)
             # only print first time
             if ind == 0:
-                print("Rebinned sino dimensions: {sinos[ind].dimensions()}")
+                print("Rebinned sino dimensions: {}".format(sino.dimensions()))
+        sinos[ind] = sino
 
+    print("Preprocessing avoided {:.1f} MB of sinogram copies".format(
+        bytes_saved / 1e6))
     return sinos
 
 
@@ -387,8 +461,9 @@ def resample_attn_images(num_ms, attns, trans, use_gpu, image):
                 resampled_attns[i] = resam.forward(attn)
     return resampled_attns
 
-def set_up_acq_models(num_ms, sinos, rands, resampled_attns, image, use_gpu):
-    """Set up acquisition models."""
+def set_up_acq_models(num_ms, sinos, rands, resampled_attns, image, use_gpu,
+                      compute_masks=True):
+    """Set up acquisition models (and masks, if compute_masks)."""
     print("Setting up acquisition models...")
 
     # From the arguments
@@ -461,7 +536,7 @@ def set_up_acq_models(num_ms, sinos, rands, resampled_attns, image, use_gpu):
             acq_models[current].subset_num = k 
 
             # compute masks 
-            if ind==0:
+            if ind==0 and compute_masks:
                 mask = acq_models[current].direct(im_one)
                 masks.append(mask)
 
@@ -471,6 +546,36 @@ def set_up_acq_models(num_ms, sinos, rands, resampled_attns, image, use_gpu):
 
     return acq_models, masks
 
+def get_blocks(num_ms, acq_models, resamplers):
+    """Blocks of the projection operator.
+
+    Acquisition models (over subsets and motion states), composed with the
+    resampler of their motion state if any."""
+    if resamplers is None:
+        return [am for am in acq_models]
+    return [CompositionOperator(am, resamplers[ind % num_ms], preallocate=True)
+            for ind, am in enumerate(acq_models)]
+
+def set_up_blocks(use_gpu):
+    """Set up the blocks of the projection operator from the arguments.
+
+    As main does, without randoms and masks, for the worker processes of
+    get_block_norms."""
+    [num_ms, trans_files, sino_files, attn_files, _] = \
+        get_filenames(args['--trans'],args['--sino'],args['--attn'],args['--rand'])
+    [trans, sinos_raw, attns, _] = \
+        read_files(trans_files, sino_files, attn_files, [], args['--trans_type'])
+    sinos = pre_process_sinos(sinos_raw, num_ms)
+    image = get_initial_estimate(sinos, use_gpu)
+    if trans is None:
+        resamplers = None
+    else:
+        resamplers = [get_resampler(image, trans=tran) for tran in trans]
+    resampled_attns = resample_attn_images(num_ms, attns, trans, use_gpu, image)
+    acq_models, _ = set_up_acq_models(
+        num_ms, sinos, [], resampled_attns, image, use_gpu, compute_masks=False)
+    return get_blocks(num_ms, acq_models, resamplers)
+
 def get_asm_attn(sino, attn, acq_model):
     """Get attn ASM from sino, attn image and acq model."""
     asm_attn = pet.AcquisitionSensitivityModel(attn, acq_model)
@@ -514,28 +619,14 @@ def set_up_reconstructor(use_gpu, num_ms, acq_models, resamplers, masks, sinos,
     # acquisition models and resamplers,
     # and create data fit functions
     
+    # (set up as by the workers of get_block_norms)
+    C = get_blocks(num_ms, acq_models, resamplers)
     if nsub == 1:
-        if resamplers is None:
-            #KT C = [am.get_linear_acquisition_model() for am in acq_models]
-            C = [am for am in acq_models]
-        else:
-            C = [CompositionOperator(
-                    #KTam.get_linear_acquisition_model(),
-                    am,
-                    res, preallocate=True)
-                    for am, res in zip(*(acq_models, resamplers))]
-        fi = [KullbackLeibler(b=sino, eta=eta, mask=masks[0].as_array(),use_numba=True) 
+        fi = [KullbackLeibler(b=sino, eta=eta, mask=masks[0].as_array(),use_numba=True)
                 for sino, eta in zip(sinos, etas)]
     else:
-        C = [am for am in acq_models]
         fi = [None] * (num_ms * nsub)
         for (k,i) in np.ndindex((nsub,num_ms)):
-            # resample if needed
-            if resamplers is not None:            
-                C[k * num_ms + i] = CompositionOperator(
-                    #KTam.get_linear_acquisition_model(),
-                    C[k * num_ms + i],
-                    resamplers[i], preallocate=True)
             fi[k * num_ms + i] = KullbackLeibler(b=sinos[i], eta=etas[i], mask=masks[k].as_array(),use_numba=True)
 
 
@@ -659,28 +750,14 @@ def set_up_explicit_reconstructor(use_gpu, num_ms, image, acq_models, resamplers
     # acquisition models and resamplers,
     # and create data fit functions
 
+    # (set up as by the workers of get_block_norms)
+    C = get_blocks(num_ms, acq_models, resamplers)
     if nsub == 1:
-        if resamplers is None:
-            #KT C = [am.get_linear_acquisition_model() for am in acq_models]
-            C = [am for am in acq_models]
-        else:
-            C = [CompositionOperator(
-                    #KTam.get_linear_acquisition_model(),
-                    am,
-                    res, preallocate=True)
-                    for am, res in zip(*(acq_models, resamplers))]
-        fi = [KullbackLeibler(b=sino, eta=eta, mask=masks[0].as_array(),use_numba=True) 
+        fi = [KullbackLeibler(b=sino, eta=eta, mask=masks[0].as_array(),use_numba=True)
                 for sino, eta in zip(sinos, etas)]
     else:
-        C = [am for am in acq_models]
         fi = [None] * (num_ms * nsub)
         for (k,i) in np.ndindex((nsub,num_ms)):
-            # resample if needed
-            if resamplers is not None:            
-                C[k * num_ms + i] = CompositionOperator(
-                    #KTam.get_linear_acquisition_model(),
-                    C[k * num_ms + i],
-                    resamplers[i], preallocate=True)
             fi[k * num_ms + i] = KullbackLeibler(b=sinos[i], eta=etas[i], mask=masks[k].as_array(),use_numba=True)
 
     # define gradient
@@ -746,43 +823,111 @@ def set_up_explicit_reconstructor(use_gpu, num_ms, image, acq_models, resamplers
     return [F, G, K, normK, tau, sigma, use_axpby, prob, gamma]
 
 
-def PowerMethod(operator, x_init=None):
+def PowerMethod(operator, x_init=None, vector_file=None):
     '''Power method to calculate iteratively the Lipschitz constant
-    
+
+    Runs --PowerMethod_iters iterations, or stops earlier when the relative
+    change of the estimate is below --PowerMethod_tol. With
+    --PowerMethod_lanczos, the Lanczos iteration is used instead.
+
     :param operator: input operator
     :type operator: :code:`LinearOperator`
-    :param iterations: number of iterations to run
-    :type iteration: int
     :param x_init: starting point for the iteration in the operator domain
+    :param vector_file: .npy file to start from (if it exists and x_init is
+        None) and to save the final vector to, for warm starts of later runs
     :returns: tuple with: L, list of L at each iteration, the data the iteration worked on.
     '''
     # From the arguments
     iterations = int(args['--PowerMethod_iters'])
+    tolerance = float(args['--PowerMethod_tol'])
 
-    # Initialise random
+    # Initialise random, or from the saved vector
     if x_init is None:
         x0 = operator.domain_geometry().allocate('random')
+        if vector_file is not None and path.isfile(vector_file):
+            x_saved = np.load(vector_file)
+            if x_saved.shape == tuple(x0.shape):
+                print("Warm start from {}".format(vector_file))
+                x0.fill(x_saved)
     else:
         x0 = x_init.copy()
-        
-    x1 = operator.domain_geometry().allocate()
+
+    if args['--PowerMethod_lanczos']:
+        s, x0 = Lanczos(operator, x0, iterations, tolerance)
+    else:
+        x1 = operator.domain_geometry().allocate()
+        y_tmp = operator.range_geometry().allocate()
+        s = []
+        # Loop
+        i = 0
+        while i < iterations:
+            operator.direct(x0,out=y_tmp)
+            operator.adjoint(y_tmp,out=x1)
+            x1norm = x1.norm()
+            if hasattr(x0, 'squared_norm'):
+                s.append( x1.dot(x0) / x0.squared_norm() )
+            else:
+                x0norm = x0.norm()
+                s.append( x1.dot(x0) / (x0norm * x0norm) ) 
+            x1.multiply((1.0/x1norm), out=x0)
+            print ("current squared norm: {}".format(s[-1]))
+            i += 1
+            if converged(s, tolerance):
+                break
+
+    if vector_file is not None:
+        os.makedirs(path.dirname(vector_file), exist_ok=True)
+        x_final = x0.as_array()
+        write_atomically(vector_file, lambda f: np.save(f, x_final))
+    return np.sqrt(s[-1]), [np.sqrt(si) for si in s], x0
+
+def Lanczos(operator, x0, iterations, tolerance):
+    '''Lanczos iteration for the largest eigenvalue of operator^T operator
+
+    Converges in fewer iterations than the power method for the same
+    operator applications. All Lanczos vectors (one image each) are kept to
+    form the dominant vector; they are not reorthogonalised, which does not
+    affect the largest eigenvalue.
+
+    :returns: tuple with: list of squared norm estimates at each iteration,
+        normalised estimate of the dominant singular vector.
+    '''
     y_tmp = operator.range_geometry().allocate()
+    w = operator.domain_geometry().allocate()
+    q = [x0 * (1.0 / x0.norm())]
+    alpha = []
+    beta = []
     s = []
-    # Loop
-    i = 0
-    while i < iterations:
-        operator.direct(x0,out=y_tmp)
-        operator.adjoint(y_tmp,out=x1)
-        x1norm = x1.norm()
-        if hasattr(x0, 'squared_norm'):
-            s.append( x1.dot(x0) / x0.squared_norm() )
-        else:
-            x0norm = x0.norm()
-            s.append( x1.dot(x0) / (x0norm * x0norm) ) 
-        x1.multiply((1.0/x1norm), out=x0)
+    for i in range(iterations):
+        operator.direct(q[-1], out=y_tmp)
+        operator.adjoint(y_tmp, out=w)
+        alpha.append(float(w.dot(q[-1])))
+        w = w - q[-1] * alpha[-1]
+        if beta:
+            w = w - q[-2] * beta[-1]
+        # largest eigenvalue of the tridiagonal Lanczos matrix
+        T = np.diag(alpha) + np.diag(beta, 1) + np.diag(beta, -1)
+        theta, y = np.linalg.eigh(T)
+        s.append(theta[-1])
         print ("current squared norm: {}".format(s[-1]))
-        i += 1
-    return np.sqrt(s[-1]), [np.sqrt(si) for si in s], x0
+        wnorm = float(w.norm())
+        # stop if converged or the Krylov space is exhausted
+        if converged(s, tolerance) or wnorm <= 1e-12 * abs(alpha[-1]):
+            break
+        if i < iterations - 1:
+            beta.append(wnorm)
+            q.append(w * (1.0 / wnorm))
+    # Ritz vector of the largest eigenvalue
+    x = q[0] * float(y[0, -1])
+    for qk, yk in zip(q[1:], y[1:, -1]):
+        x = x + qk * float(yk)
+    return s, x * (1.0 / x.norm())
+
+def converged(s, tolerance):
+    '''Whether the relative change of the norm estimates is below tolerance'''
+    if tolerance <= 0 or len(s) < 2:
+        return False
+    return abs(np.sqrt(s[-1]) - np.sqrt(s[-2])) <= tolerance * np.sqrt(s[-1])
 
 def precond_proximal(self, x, tau, out=None):
 
@@ -838,42 +983,198 @@ def MixedL21Norm_proximal(self, x, tau, out):
 
 def get_proj_norm(K,param_path):
     # load or compute and save norm of whole operator
-    file_path = '{}/normK.npy'.format(param_path)
-    if os.path.isfile(file_path):
-        print('Norm file {} exists, load it'.format(file_path))
-        normK = float(np.load(file_path, allow_pickle=True))
-    else:
-        print('Norm file {} does not exist, compute it'.format(file_path))
-        normK = PowerMethod(K)[0]
-        # save to file
-        np.save(file_path, normK, allow_pickle=True)
-    return normK
+    config = get_proj_norm_config(K)
+    vector_file = get_vector_file(param_path, 'normK')
+    return load_or_compute_norm(param_path, 'normK', config,
+                                lambda: PowerMethod(K, vector_file=vector_file)[0])
 
 def get_proj_normi(K,nsub,param_path):
     # load or compute and save norm of each sub-operator
     # (over motion states and subsets)
-    file_path = '{}/normK_nsub{}.npy'.format(param_path, nsub)
-    if os.path.isfile(file_path):
-        print('Norm file {} exists, load it'.format(file_path))
-        normK = np.load(file_path, allow_pickle=True).tolist()
-    else: 
-        print('Norm file {} does not exist, compute it'.format(file_path))
-        normK = [PowerMethod(Ki)[0] for Ki in K]
-        # save to file
-        np.save(file_path, normK, allow_pickle=True)
-    return normK
+    config = get_proj_norm_config(K)
+    name = 'normK_nsub{}'.format(nsub)
+    vector_files = [get_vector_file(param_path, '{}_block{}'.format(name, ind))
+                    for ind in range(len(K))]
+    return load_or_compute_norm(param_path, name, config,
+                                lambda: get_block_norms(K, nsub, vector_files))
+
+def get_block_norms(K, nsub, vector_files=None):
+    """Compute the norms of the blocks of K concurrently.
+
+    SIRF objects cannot be pickled, and forked children of a process that
+    has run OpenMP parallel regions hang with GCC's runtime, so the norms
+    are computed in spawned worker processes that set up their own blocks
+    from the arguments (see set_up_blocks), each using its share of
+    --numThreads OpenMP threads. Workers are limited to those whose input
+    sinograms and power method buffers fit the available memory. Norms are
+    computed here with one worker or the GPU projector. vector_files are
+    passed on to PowerMethod, one per block."""
+    if vector_files is None:
+        vector_files = [None] * len(K)
+    if args['--numNormWorkers']:
+        num_workers = int(args['--numNormWorkers'])
+    else:
+        num_workers = int(numThreads)
+    num_workers = max(1, min(num_workers, len(K)))
+    available = get_available_memory()
+    if available is not None:
+        # one sinogram per motion state, of the size of the range of a block
+        num_ms = len(K) // nsub
+        worker_bytes = max(num_ms * get_geometry_bytes(Ki.range_geometry()) +
+                           get_power_method_bytes(Ki) for Ki in K)
+        num_workers = max(1, min(num_workers, available // worker_bytes))
+    if num_workers == 1 or args['--gpu']:
+        return [PowerMethod(Ki, vector_file=vector_file)[0]
+                for Ki, vector_file in zip(K, vector_files)]
+    threads_per_worker = max(1, int(numThreads) // num_workers)
+    print("Computing {} block norms on {} workers with {} threads each".format(
+        len(K), num_workers, threads_per_worker))
+    jobs = [(ind, vector_file, threads_per_worker)
+            for ind, vector_file in enumerate(vector_files)]
+    with multiprocessing.get_context('spawn').Pool(num_workers) as pool:
+        return pool.starmap(_block_norm, jobs, chunksize=1)
+
+# blocks set up by a worker process of get_block_norms
+_norm_blocks = None
+
+def _block_norm(ind, vector_file, num_threads):
+    global _norm_blocks
+    if _norm_blocks is None:
+        pet.set_max_omp_threads(num_threads)
+        # (norms with the GPU projector are computed in the main process)
+        _norm_blocks = set_up_blocks(use_gpu=False)
+    return PowerMethod(_norm_blocks[ind], vector_file=vector_file)[0]
+
+def get_available_memory():
+    """Available memory in bytes, None if unknown.
+
+    MemAvailable, which unlike free memory includes the page cache that can
+    be reclaimed."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def get_geometry_bytes(geometry):
+    """Bytes of the data of a geometry (float32 unless it has a dtype)."""
+    itemsize = np.dtype(getattr(geometry, 'dtype', np.float32)).itemsize
+    return int(np.prod(geometry.shape)) * itemsize
+
+def get_power_method_bytes(operator):
+    """Bytes of the buffers of PowerMethod for operator.
+
+    One range (sinogram) and three domain (image) buffers, plus one image
+    per iteration for the Lanczos vectors."""
+    num_images = 3
+    if args['--PowerMethod_lanczos']:
+        num_images += int(args['--PowerMethod_iters'])
+    return get_geometry_bytes(operator.range_geometry()) + \
+        num_images * get_geometry_bytes(operator.domain_geometry())
 
 def get_grad_norm(Grad,param_path):
-    file_path = '{}/normGrad.npy'.format(param_path)
-    if os.path.isfile(file_path):
-        print('Norm file {} exists, load it'.format(file_path))
-        normG = float(np.load(file_path, allow_pickle=True))
-    else:
-        print('Norm file {} does not exist, compute it'.format(file_path))
-        normG = PowerMethod(Grad)[0]
-        # save to file
-        np.save(file_path, normG, allow_pickle=True)
-    return normG
+    config = get_geometry_config(Grad.domain_geometry())
+    vector_file = get_vector_file(param_path, 'normGrad')
+    return load_or_compute_norm(param_path, 'normGrad', config,
+                                lambda: PowerMethod(Grad, vector_file=vector_file)[0])
+
+def load_or_compute_norm(param_path, name, config, compute):
+    """Load a cached operator norm, or compute and cache it.
+
+    Norms are stored in param_path/norms as <name>_<fingerprint>.npy, where
+    the fingerprint hashes config, with config and timing in a .json file
+    alongside. Files are written under temporary names and renamed, so runs
+    sharing param_path never see partially written files."""
+    config = dict(config, name=name,
+                  PowerMethod_iters=int(args['--PowerMethod_iters']),
+                  PowerMethod_tol=float(args['--PowerMethod_tol']),
+                  PowerMethod_lanczos=bool(args['--PowerMethod_lanczos']))
+    fingerprint = hashlib.sha256(
+        json.dumps(config, sort_keys=True).encode()).hexdigest()
+    cache_path = path.join(param_path, 'norms')
+    os.makedirs(cache_path, exist_ok=True)
+    file_path = path.join(cache_path, '{}_{}'.format(name, fingerprint))
+    if path.isfile(file_path + '.npy'):
+        print('Norm file {}.npy exists, load it'.format(file_path))
+        return np.load(file_path + '.npy').tolist()
+    print('Norm file {}.npy does not exist, compute it'.format(file_path))
+    start = time.time()
+    norm = compute()
+    meta = {'config': config, 'norm': norm, 'seconds': time.time() - start,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    # save to file, the .npy last as its presence marks a cache hit
+    write_atomically(file_path + '.json',
+                     lambda f: json.dump(meta, f, indent=1), mode='w')
+    write_atomically(file_path + '.npy',
+                     lambda f: np.save(f, np.asarray(norm, dtype=np.float64)))
+    return norm
+
+def get_vector_file(param_path, name):
+    """File of the dominant singular vector of an operator.
+
+    Unlike the norms, vectors are not keyed by the configuration, so that
+    runs with a slightly different configuration start from them."""
+    return path.join(param_path, 'norms', '{}_vector.npy'.format(name))
+
+def write_atomically(file_path, write, mode='wb'):
+    """Write a file under a temporary name and rename it into place."""
+    tmp = '{}.{}.{}.tmp'.format(file_path, socket.gethostname(), os.getpid())
+    with open(tmp, mode) as f:
+        write(f)
+    os.replace(tmp, file_path)
+
+def get_geometry_config(geometry):
+    """Configuration of the domain of an operator."""
+    config = {'shape': [int(n) for n in geometry.shape]}
+    if hasattr(geometry, 'voxel_sizes'):
+        config['voxel_sizes'] = [float(v) for v in geometry.voxel_sizes()]
+    return config
+
+def get_proj_norm_config(K):
+    """Configuration that the norms of the projection operator depend on.
+
+    Files are identified by their content, so that runs on other machines
+    share norms; only the headers of the sinograms matter."""
+    algo = str(args['--algorithm'])
+    [num_ms, trans_files, sino_files, attn_files, rand_files] = \
+        get_filenames(args['--trans'],args['--sino'],args['--attn'],args['--rand'])
+    config = get_geometry_config(K.domain_geometry())
+    config.update({
+        'num_blocks': len(K) if hasattr(K, '__len__') else 1,
+        'num_gates': num_ms,
+        'num_subsets': int(args['--numSubsets']) if args['--numSubsets'] and algo=='spdhg' else 1,
+        'sinos': [hash_file(file, data=False) for file in sino_files],
+        'attns': [hash_file(file) for file in attn_files],
+        'trans': [hash_file(file) for file in trans_files],
+        'trans_type': args['--trans_type'] if trans_files else None,
+        'norm': hash_file(args['--norm']) if args['--norm'] else None,
+        'gpu': bool(args['--gpu']),
+        'numSegsToCombine': int(args['--numSegsToCombine'] or 1),
+        'numViewsToCombine': int(args['--numViewsToCombine'] or 1),
+        'templateAcqData': bool(args['--templateAcqData'])})
+    return config
+
+def hash_file(filename, data=True):
+    """SHA-256 of the content of a file.
+
+    For Interfile headers, the data file named in the header is included
+    if data is True."""
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        header = f.read()
+    h.update(header)
+    if data and filename.lower().endswith(('.hs', '.hv', '.hdr')):
+        for line in header.decode('latin-1').splitlines():
+            key, sep, value = line.partition(':=')
+            if sep and key.strip().lower() == 'name of data file':
+                data_file = path.join(path.dirname(filename), value.strip())
+                with open(data_file, 'rb') as f:
+                    for block in iter(partial(f.read, 1 << 20), b''):
+                        h.update(block)
+    return h.hexdigest()
 
 
 def get_output_filename(attn_files, normK, sigma, tau, sino_files, resamplers, use_gpu):
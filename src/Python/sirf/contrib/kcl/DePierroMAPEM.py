@@ -0,0 +1,187 @@
+'''De Pierro MAPEM reconstructor
+De Pierro's modified MAPEM algorithm for weighted quadratically penalised PET
+image reconstruction (Wang and Qi (2015) formulation), wrapping SIRF's
+OSMAPOSLReconstructor for the EM step. Each subiteration runs in memory; with
+acquisition data in the 'memory' storage scheme (set by the scripts at
+start-up) no temporary files are written to the working directory either.
+'''
+
+## CCP PETMR Synergistic Image Reconstruction Framework (SIRF)
+## Copyright 2015 - 2017 Rutherford Appleton Laboratory STFC
+## Copyright 2015 - 2017 University College London.
+##
+## This is software developed for the Collaborative Computational
+## Project in Positron Emission Tomography and Magnetic Resonance imaging
+## (http://www.ccppetmr.ac.uk/).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+##   you may not use this file except in compliance with the License.
+##   You may obtain a copy of the License at
+##       http://www.apache.org/licenses/LICENSE-2.0
+##   Unless required by applicable law or agreed to in writing, software
+##   distributed under the License is distributed on an "AS IS" BASIS,
+##   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##   See the License for the specific language governing permissions and
+##   limitations under the License.
+
+import numpy as np
+import sirf.STIR as pet
+
+from .dePierro import DePierroReg, DePierroUpdate
+
+
+class DePierroMAPEM(object):
+    # obj_fun: Poisson log-likelihood with its acquisition model (subsets are
+    # set here), weights: normalised voxels x window weights (dense or
+    # Prior.CompactWeights), sensitivity_image: sensitivity for all data,
+    # filter: optional processor applied after each subiteration (e.g.
+    # TruncateToCylinderProcessor), backend: 'numpy' or 'numba' for the
+    # regularisation and image update, dtype: type they work in (by default
+    # that of the images, as returned by as_array), mask: boolean image of
+    # the voxels regularised and updated (e.g. Prior.cylinderMask for the
+    # field of view kept by the filter), weights then having one row per
+    # voxel in the mask, numThreads: threads of the regularisation and image
+    # update (by default numba's setting with numba, see Prior).
+    #
+    #   recon = DePierroMAPEM(obj_fun, weights, beta, sensitivity_image, filter)
+    #   recon.set_up(initial_image)
+    #   image = recon.run(num_subiterations)
+    #
+    # num_subiterations is an upper bound if run is given a
+    # ConvergenceMonitor, which stops the run once its tolerances are met.
+
+    def __init__(self, obj_fun, weights, beta, sensitivity_image, filter=None,
+                 num_subsets=12, num_subiterations=24, backend='numpy',
+                 dtype=None, mask=None, numThreads=None):
+
+        self.obj_fun = obj_fun
+        self.weights = weights
+        self.beta = beta
+        self.sensitivity_image = sensitivity_image
+        self.filter = filter
+        self.num_subsets = num_subsets
+        self.num_subiterations = num_subiterations
+        self.backend = backend
+        self.dtype = dtype
+        self.mask = mask
+        self.numThreads = numThreads
+        self.reconstructor = None
+
+    def set_up(self, image):
+
+        # Regularisation operator and image update, set up once for all
+        # subiterations (checks that the weights are normalised)
+        image_array = image.as_array()
+        dtype = image_array.dtype if self.dtype is None else self.dtype
+        self.imageReg = DePierroReg(image_array.shape, self.weights, numThreads=self.numThreads,
+                                    backend=self.backend, dtype=dtype, mask=self.mask)
+        self.imageUpdate = DePierroUpdate(self.beta, self.sensitivity_image.as_array(),
+                                          self.backend, dtype, self.mask, self.numThreads)
+
+        # OSEM reconstructor for the EM step
+        self.reconstructor = pet.OSMAPOSLReconstructor()
+        self.reconstructor.set_objective_function(self.obj_fun)
+        self.reconstructor.set_num_subsets(self.num_subsets)
+        self.reconstructor.set_num_subiterations(self.num_subiterations)
+        self.reconstructor.set_up(image)
+
+        self.current_image = image.clone()
+        self.subiteration = 0
+
+    def update(self):
+
+        if self.reconstructor is None:
+            raise RuntimeError("set_up must be called before update")
+
+        # Calculate imageReg and return as an array
+        self.previous_array = self.current_image.as_array()
+        imageReg_array = self.imageReg(self.previous_array)
+
+        # OSEM image update
+        self.reconstructor.update(self.current_image)
+        imageEM_array = self.current_image.as_array()
+
+        # Final image update
+        imageUpdated_array = self.imageUpdate \
+            (imageEM_array, imageReg_array, out=imageEM_array)
+
+        # Fill image and truncate to cylindrical field of view
+        self.current_image.fill(imageUpdated_array)
+        if self.filter is not None:
+            self.filter.apply(self.current_image)
+        self.subiteration += 1
+
+    def run(self, num_subiterations=None, verbose=True, monitor=None):
+
+        if num_subiterations is None:
+            num_subiterations = self.num_subiterations
+        for _ in range(num_subiterations):
+            if verbose:
+                print('\n------------- Subiteration %d' % (self.subiteration + 1))
+            self.update()
+            if monitor is not None and monitor.update(self):
+                if verbose:
+                    print('Converged after %d subiterations' % self.subiteration)
+                break
+        return self.get_output()
+
+    def objective(self, image=None):
+        # penalised objective: log-likelihood - beta/8*sum_jk w_jk*(x_j - x_k)**2,
+        # which the update maximises for symmetric weights (w_jk = w_kj). For
+        # asymmetric weights (e.g. Bowsher) the update's fixed point is not
+        # its maximiser, and it only tracks progress as a heuristic
+        if image is None:
+            image = self.current_image
+        return self.obj_fun.value(image) \
+            - self.beta/8.0*self.imageReg.penalty(image.as_array())
+
+    def get_current_estimate(self):
+        return self.current_image
+
+    def get_output(self):
+        return self.current_image.clone()
+
+
+class ConvergenceMonitor(object):
+    # Stopping rule for DePierroMAPEM.run. After every subiteration the
+    # relative image change ||x_n+1 - x_n||/||x_n|| is recorded, and every
+    # objective_interval epochs (of num_subsets subiterations) the penalised
+    # objective. The run stops when every tolerance given is met: rel_tol by
+    # all image changes over the last epoch, obj_tol by the relative change
+    # between the last two objective values (a heuristic with asymmetric
+    # weights, see DePierroMAPEM.objective).
+
+    def __init__(self, rel_tol=None, obj_tol=None, objective_interval=1):
+
+        self.rel_tol = rel_tol
+        self.obj_tol = obj_tol
+        self.objective_interval = objective_interval
+        self.changes = []
+        self.objectives = []
+
+    def update(self, recon):
+
+        previous = recon.previous_array
+        norm = np.linalg.norm(previous)
+        previous -= recon.get_current_estimate().as_array()
+        self.changes.append(np.linalg.norm(previous)/norm if norm>0 else np.inf)
+
+        epoch = recon.num_subsets
+        if self.obj_tol is not None and recon.subiteration % (self.objective_interval*epoch) == 0:
+            self.objectives.append((recon.subiteration, recon.objective()))
+        return self.converged(epoch)
+
+    def converged(self, epoch):
+
+        if self.rel_tol is None and self.obj_tol is None:
+            return False
+        if self.rel_tol is not None:
+            if len(self.changes)<epoch or max(self.changes[-epoch:])>=self.rel_tol:
+                return False
+        if self.obj_tol is not None:
+            if len(self.objectives)<2:
+                return False
+            previous, current = self.objectives[-2][1], self.objectives[-1][1]
+            if abs(current - previous) > self.obj_tol*abs(current):
+                return False
+        return True
@@ -1,63 +1,409 @@
 
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import warnings
 import numpy as np
 
+try:
+    from . import numbaKernels
+except ImportError:
+    numbaKernels = None
+
+
+class Stencil(object):
+    # Offset description of a search window on a (cropped) image grid.
+    # Neighbours are read from shifted views of a padded copy of the image,
+    # so no voxel x window index or distance matrix is stored.
+
+    # boundary mode -> np.pad mode used to build the padded index
+    boundaries = {'periodic': 'wrap', 'symmetric': 'symmetric', 'edge': 'edge'}
+
+    def __init__(self, imageSize, w, boundary='periodic'):
+
+        self.imageSize = [int(s) for s in imageSize]
+        r = int(w//2)
+        rz = r if self.imageSize[2]>1 else 0
+        self.pad = [r, r, rz]
+        self.offsets = np.array([[x,y,z] for x in range(-r,r+1)
+                                         for y in range(-r,r+1)
+                                         for z in range(-rz,rz+1)], dtype='int')
+        self.nS = self.offsets.shape[0]
+        self.nVoxels = int(np.prod(self.imageSize))
+        self.distance = np.sqrt(np.sum(self.offsets**2,axis=1))
+        if boundary not in self.boundaries:
+            raise ValueError("boundary must be one of " + ", ".join(self.boundaries))
+        self.boundary = boundary
+        # index into the image for each padded position
+        self.padIndex = [np.pad(np.arange(n), p, mode=self.boundaries[boundary])
+                         for n,p in zip(self.imageSize,self.pad)]
+        self.__denseIndex = None
+
+    @property
+    def nbytes(self):
+        nbytes = self.offsets.nbytes + self.distance.nbytes + sum(i.nbytes for i in self.padIndex)
+        if self.__denseIndex is not None:
+            nbytes += self.__denseIndex.nbytes
+        return nbytes
+
+    def padImage(self,img,z0=0,z1=None,channels=False):
+        # padded copy of planes z0:z1 plus a one-window halo (of each image
+        # along the first axis if channels)
+        z1 = self.imageSize[2] if z1 is None else z1
+        lead = [np.shape(img)[0]] if channels else []
+        img = np.reshape(img,lead+self.imageSize)
+        zIndex = self.padIndex[2][z0:z1+2*self.pad[2]]
+        return img[(Ellipsis,)+np.ix_(self.padIndex[0], self.padIndex[1], zIndex)]
+
+    def shift(self,padded,l):
+        n,m,h = np.array(padded.shape[-3:]) - 2*np.array(self.pad)
+        x,y,z = self.offsets[l] + self.pad
+        return padded[..., x:x+n, y:y+m, z:z+h]
+
+    def columns(self,img,op,z0=0,z1=None):
+        # voxels x window array of op(neighbour, voxel) for planes z0:z1,
+        # voxels in 'F' order
+        z1 = self.imageSize[2] if z1 is None else z1
+        img = np.reshape(img,self.imageSize)
+        padded = self.padImage(img,z0,z1)
+        centre = img[:,:,z0:z1]
+        out = np.empty([self.nS]+list(centre.shape[::-1]), dtype=img.dtype)
+        for l in range(self.nS):
+            op(self.shift(padded,l), centre, out=out[l].T)
+        return out.reshape(self.nS,-1).T
+
+    def neighbours(self,coords,l):
+        # 'F' order index of neighbour l of the voxels at grid coordinates
+        # coords (i,j,k arrays), e.g. from voxelCoordinates; l may be an
+        # array of one window position per voxel
+        n,m,_ = self.imageSize
+        x,y,z = (self.offsets[l] + self.pad).T
+        i,j,k = coords
+        xi,yi,zi = self.padIndex
+        return xi[i+x] + n*(yi[j+y] + m*zi[k+z])
+
+    def voxelCoordinates(self,voxels):
+        # grid coordinates of 'F' order voxel indices
+        n,m,_ = self.imageSize
+        return voxels % n, (voxels//n) % m, voxels//(n*m)
+
+    def slabs(self,slabSize=None):
+        h = self.imageSize[2]
+        slabSize = h if slabSize is None else max(1,int(slabSize))
+        return [(z, min(z+slabSize,h)) for z in range(0,h,slabSize)]
+
+    def denseIndex(self):
+        # voxels x window index, built once and kept with the plan
+        if self.__denseIndex is None:
+            n,m,h = self.imageSize
+            X,Y,Z = np.meshgrid(np.arange(n), np.arange(m), np.arange(h), indexing='ij')
+            xi,yi,zi = self.padIndex
+            N = np.zeros([self.nVoxels, self.nS],dtype='int32')
+            for l,(x,y,z) in enumerate(self.offsets + self.pad):
+                N[:,l] = (xi[X+x] + yi[Y+y]*n + zi[Z+z]*n*m).flatten('F')
+            self.__denseIndex = N
+        return self.__denseIndex
+
+
+class PlanCache(object):
+    # Process-wide LRU cache of Stencil plans keyed by geometry. Plans are
+    # evicted, least recently used first, beyond maxPlans entries or once
+    # their total size (including any dense index built) exceeds maxBytes.
+
+    def __init__(self, maxPlans=32, maxBytes=2**31):
+        self.maxPlans = maxPlans
+        self.maxBytes = maxBytes
+        self.plans = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        with self.lock:
+            plan = self.plans.pop(key, None)
+            if plan is None:
+                plan = build()
+            self.plans[key] = plan
+            while len(self.plans)>1 and (len(self.plans)>self.maxPlans or self.nbytes>self.maxBytes):
+                self.plans.popitem(last=False)
+            return plan
+
+    @property
+    def nbytes(self):
+        return sum(plan.nbytes for plan in self.plans.values())
+
+    def clear(self):
+        with self.lock:
+            self.plans.clear()
+
+
+planCache = PlanCache()
+
+
+def getStencil(imageSize, w, imageCropFactor=[0], boundary='periodic', imageSizeCrop=None):
+    # shared plan for a geometry; imageSizeCrop is the grid the stencil
+    # works on if the image is cropped
+    key = (tuple(int(s) for s in imageSize), int(w), tuple(imageCropFactor), boundary)
+    gridSize = imageSize if imageSizeCrop is None else imageSizeCrop
+    return planCache.get(key, lambda: Stencil(gridSize, w, boundary))
+
+
+# Pair potentials phi(x_j, x_k) of the penalties in Prior.penalty, with their
+# first and second derivatives with respect to x_j; d = x_j - x_k
+
+def _quadratic(xj,xk,d,delta,gamma,epsilon):
+    return d**2, 2*d, 2.0
+
+def _logcosh(xj,xk,d,delta,gamma,epsilon):
+    # 2*delta**2*log(cosh(d/delta)), ~d**2 for |d| << delta
+    t = np.abs(d/delta)
+    phi = 2*delta**2*(t + np.log1p(np.exp(-2*t)) - np.log(2))
+    tanh = np.tanh(d/delta)
+    return phi, 2*delta*tanh, 2*(1 - tanh**2)
+
+def _relativeDifference(xj,xk,d,delta,gamma,epsilon):
+    # d**2/(x_j + x_k + gamma*|d| + epsilon)
+    absd = np.abs(d)
+    D = xj + xk + gamma*absd + epsilon
+    return d**2/D, d*(gamma*absd + xj + 3*xk + 2*epsilon)/D**2, 2*(2*xk + epsilon)**2/D**3
+
+
+class CompactWeights(object):
+    # 0/1 weights over the search window kept as one bit per window position
+    # (np.packbits along the window, little bit order) and a single scale,
+    # e.g. 1/b for normalised Bowsher weights. Indexing with [:,l] returns
+    # the scaled weights of window position l, as for a dense array.
+
+    _popcount = np.array([bin(i).count('1') for i in range(256)], dtype='uint8')
+
+    def __init__(self, bits, nS, scale=1.0, dtype='float'):
+        self.bits = bits
+        self.nS = nS
+        self.scale = scale
+        self.dtype = np.dtype(dtype)
+
+    @classmethod
+    def fromDense(cls, W, scale=1.0, dtype='float'):
+        return cls(np.packbits(W!=0, axis=1, bitorder='little'), W.shape[1], scale, dtype)
+
+    @classmethod
+    def full(cls, nVoxels, nS, scale=1.0, dtype='float'):
+        return cls.fromDense(np.ones([nVoxels, nS], dtype='bool'), scale, dtype)
+
+    @property
+    def shape(self):
+        return (self.bits.shape[0], self.nS)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            return CompactWeights(self.bits[key], self.nS, self.scale, self.dtype)
+        rows, l = key
+        col = (self.bits[rows, l>>3] >> (l&7)) & 1
+        return np.multiply(col, self.scale, dtype=self.dtype)
+
+    def __mul__(self, s):
+        return CompactWeights(self.bits, self.nS, self.scale*s, self.dtype)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, s):
+        return CompactWeights(self.bits, self.nS, self.scale/s, self.dtype)
+
+    def astype(self, dtype):
+        return CompactWeights(self.bits, self.nS, self.scale, dtype)
+
+    def sum(self, axis=None, dtype=None, out=None):
+        if axis is None:
+            s = np.sum(self._popcount[self.bits], dtype='int64')*self.scale
+        elif axis==1 or axis==-1:
+            s = np.sum(self._popcount[self.bits], axis=1, dtype='int64')*self.scale
+        else:
+            s = np.sum(self.toDense(), axis=axis)
+        s = np.asarray(s, dtype=self.dtype if dtype is None else dtype)
+        if out is not None:
+            out[...] = s
+            return out
+        return s
+
+    def toDense(self):
+        W = np.unpackbits(self.bits, axis=1, count=self.nS, bitorder='little')
+        return np.multiply(W, self.scale, dtype=self.dtype)
+
+
+class SparseWeights(object):
+    # k weights per voxel kept as their window positions (index) and values,
+    # all other window positions having weight 0 (e.g. the top-k non-local
+    # weights of Prior.nonLocalWeights). Indexing with [:,l] returns the
+    # weights of window position l, as for a dense array; GradT, imageReg
+    # and penalty loop over the k slots instead of the window.
+
+    def __init__(self, index, values, nS):
+        self.index = index
+        self.values = values
+        self.nS = nS
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def shape(self):
+        return (self.index.shape[0], self.nS)
+
+    @property
+    def nbytes(self):
+        return self.index.nbytes + self.values.nbytes
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            return SparseWeights(self.index[key], self.values[key], self.nS)
+        # O(k) per row: Prior works slot by slot on SparseWeights instead
+        rows, l = key
+        hit = self.index[rows]==np.expand_dims(l,-1)
+        return np.sum(self.values[rows]*hit, axis=1, dtype=self.dtype)
+
+    def __mul__(self, s):
+        return SparseWeights(self.index, self.values*s, self.nS)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, s):
+        return SparseWeights(self.index, self.values/s, self.nS)
+
+    def astype(self, dtype):
+        return SparseWeights(self.index, self.values.astype(dtype), self.nS)
+
+    def sum(self, axis=None, dtype=None, out=None):
+        if axis is None or axis==1 or axis==-1:
+            return np.sum(self.values, axis=axis, dtype=dtype, out=out)
+        return np.sum(self.toDense(), axis=axis, dtype=dtype, out=out)
+
+    def toDense(self):
+        W = np.zeros(self.shape, dtype=self.dtype)
+        np.put_along_axis(W, self.index.astype('intp'), self.values, axis=1)
+        return W
+
+
+def _boxSum(a, radius, modes):
+    # sum over the (2r+1) box along each axis around every element, from
+    # cumulative sums of a padded with the given np.pad modes
+    for axis,(r,mode) in enumerate(zip(radius,modes)):
+        if r==0:
+            continue
+        width = [(0,0)]*a.ndim
+        width[axis] = (r+1,r)
+        c = np.cumsum(np.pad(a, width, mode=mode), axis=axis)
+        n = a.shape[axis]
+        upper = [slice(None)]*a.ndim
+        lower = [slice(None)]*a.ndim
+        upper[axis] = slice(2*r+1, 2*r+1+n)
+        lower[axis] = slice(0, n)
+        a = c[tuple(upper)] - c[tuple(lower)]
+    return a
+
+
+def cylinderMask(imageSize, axis=0, radius=None):
+    # voxels inside the cylinder along axis inscribed in the other two (the
+    # transaxial plane; axis 0 for SIRF image arrays), as for SIRF's
+    # TruncateToCylinderProcessor. radius in voxels, by default half the
+    # smaller transaxial size.
+    imageSize = list(imageSize)
+    axes = [a for a in range(len(imageSize)) if a!=axis%len(imageSize)]
+    centres = [(imageSize[a]-1)/2.0 for a in axes]
+    if radius is None:
+        radius = min(imageSize[a] for a in axes)/2.0
+    u,v = np.meshgrid(np.arange(imageSize[axes[0]])-centres[0], np.arange(imageSize[axes[1]])-centres[1],
+                      indexing='ij')
+    disc = u**2 + v**2 <= radius**2
+    shape = [imageSize[a] if a in axes else 1 for a in range(len(imageSize))]
+    return np.broadcast_to(np.reshape(disc,shape), imageSize).copy()
+
+
+def checkBackend(backend):
+    if backend not in ('numpy', 'numba'):
+        raise ValueError("backend must be 'numpy' or 'numba'")
+    if backend=='numba' and numbaKernels is None:
+        warnings.warn("numba is not available, using the NumPy backend")
+        backend = 'numpy'
+    return backend
+
 
 class Prior(object):
         
-    def __init__(self,imageSize, sWindowSize=3, imageCropFactor=[0]):
+    def __init__(self,imageSize, sWindowSize=3, imageCropFactor=[0], memoryBudget=None, numThreads=None,
+                 boundary='periodic', backend='numpy', dtype=None, mask=None):
         
-        self.imageSize = imageSize if len(imageSize)==3 else imageSize.append(1)
+        # memoryBudget: approximate working memory in bytes for the voxels x
+        # window intermediates; operations then run over z-slabs that fit it.
+        # numThreads: slabs are processed on a pool of this many threads
+        # (NumPy releases the GIL), numba kernels on this many numba threads;
+        # results do not depend on it. By default numba's setting with the
+        # numba backend, otherwise 1.
+        # backend: 'numpy', or 'numba' for compiled kernels that loop over
+        # voxels and window offsets in parallel (NumPy if numba is missing).
+        # dtype: if given (e.g. 'float32'), images are taken in this type and
+        # the distance and built weights, intermediates and results kept in
+        # it; otherwise results follow NumPy's type promotion.
+        # mask: boolean image (e.g. cylinderMask) of the voxels to work on;
+        # voxels x window arrays then have one row per voxel in the mask
+        # ('F' order), neighbours are gathered from the whole image and
+        # images returned are zero outside the mask.
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.memoryBudget = memoryBudget
+        self.boundary = boundary
+        self.backend = checkBackend(backend)
+        if numThreads is None:
+            numThreads = numbaKernels.numba.get_num_threads() if self.backend=='numba' else 1
+        self.numThreads = numThreads
+        self.imageSize = list(imageSize) if len(imageSize)==3 else list(imageSize)+[1]
         self.imageCropFactor = imageCropFactor
         if np.mod(sWindowSize,2):
             self.sWindowSize = sWindowSize
         else:
             raise ValueError("search window size must be odd")
-        self.is3D = 1 if imageSize[2]>1 else 0 
+        self.is3D = 1 if self.imageSize[2]>1 else 0 
         self.nS = sWindowSize**3 if self.is3D else sWindowSize**2
         _,self.imageSizeCrop= self.imCrop()  
-        self.SearchWindow, self.Wd = self.__neighborhood(self.sWindowSize)
+        self.stencil, self.Wd = self.__neighborhood(self.sWindowSize)
+        self.voxels, self.coords = self.__activeVoxels(mask)
 
     def __neighborhood(self,w):
         
-        n = self.imageSizeCrop[0]
-        m = self.imageSizeCrop[1]
-        h = self.imageSizeCrop[2]
-        wlen = 2*np.floor(w/2)
-        widx = xidx = yidx = np.arange(-wlen/2,wlen/2+1)
-
-        if h==1:
-            zidx = [0]
-            nN = w*w
-        else:
-            zidx = widx
-            nN = w*w*w
-        
-        Y,X,Z = np.meshgrid(np.arange(0,m), np.arange(0,n), np.arange(0,h))                
-        N = np.zeros([n*m*h, nN],dtype='int32')
-        D = np.zeros([n*m*h, nN],dtype='float')
-        l = 0
-        for x in xidx:
-            Xnew = self.__setBoundary(X + x, n)
-            for y in yidx:
-                Ynew = self.__setBoundary(Y + y, m)
-                for z in zidx:
-                    Znew = self.__setBoundary(Z + z, h)
-                    N[:,l] = (Xnew + (Ynew)*n + (Znew)*n*m).reshape(-1,1).flatten('F')
-                    D[:,l] = np.sqrt(x**2+y**2+z**2)
-                    l += 1
-        D = 1/D
-        D[np.isinf(D)]= 0
-        D = D/np.sum(D,axis=1).reshape(-1,1)
-        return N, D
-    
-    def __setBoundary(self,X,n):
-        idx = X<0
-        X[idx] = X[idx]+n
-        idx = X>n-1
-        X[idx] = X[idx]-n
-        return X.flatten('F')
+        stencil = getStencil(self.imageSize, w, self.imageCropFactor, self.boundary, self.imageSizeCrop)
+        D = np.zeros(stencil.nS)
+        D[stencil.distance>0] = 1/stencil.distance[stencil.distance>0]
+        D = D/np.sum(D)
+        return stencil, self.__cast(D)
 
+    def __activeVoxels(self,mask):
+        if mask is None:
+            return None, None
+        mask,_ = self.imCrop(np.reshape(np.asarray(mask,dtype=bool),self.imageSize))
+        voxels = np.flatnonzero(np.ravel(mask,order='F'))
+        if voxels.size==0:
+            raise ValueError("mask has no voxels")
+        return voxels, self.stencil.voxelCoordinates(voxels)
+
+    @property
+    def nVoxels(self):
+        # rows of the voxels x window arrays
+        return self.stencil.nVoxels if self.voxels is None else self.voxels.size
+
+    def __cast(self,a):
+        # a in the dtype of the prior (no copy if it already is)
+        return a if self.dtype is None else np.asarray(a, dtype=self.dtype)
+
+    def __resultType(self,*arrays):
+        return np.result_type(*arrays) if self.dtype is None else self.dtype
+
+    @property
+    def SearchWindow(self):
+        # dense voxels x window index, only built when asked for
+        return self.stencil.denseIndex()
+    
     def imCrop(self,img=None):
         if np.any(self.imageCropFactor):
             if len(self.imageCropFactor)==1:
@@ -99,43 +445,511 @@ class Prior(object):
                 img[I:self.imageSize[0]-I, J:self.imageSize[1]-J] = tmp 
         return img
     
-    def Grad(self,img):
+    def __numbaImage(self,img):
         img,_ = self.imCrop(img)
-        img = img.flatten('F')
-        imgGrad = img[self.SearchWindow] - img.reshape(-1,1)
-        imgGrad[np.isnan(imgGrad)] = 0
-        return imgGrad
+        return np.ascontiguousarray(np.reshape(img,self.imageSizeCrop))
+
+    def __numbaStencil(self):
+        xi,yi,zi = self.stencil.padIndex
+        voxels = np.zeros(0,'int64') if self.voxels is None else self.voxels
+        return xi, yi, zi, self.stencil.offsets + self.stencil.pad, voxels
+
+    def __numba(self,weights=None):
+        # SparseWeights are only handled by the NumPy code
+        return self.backend=='numba' and not isinstance(weights,SparseWeights)
+
+    def __numbaCall(self,kernel,*args):
+        # kernels run on numThreads numba threads whatever other Priors use
+        with numbaKernels.threads(self.numThreads):
+            kernel(*args)
+
+    def __numbaWeights(self,weights,dtype):
+        # (dense weights, bits, scale, mode) arguments of the kernels
+        noWeights = np.zeros((0,0),dtype)
+        noBits = np.zeros((0,0),'uint8')
+        if weights is None:
+            return noWeights, noBits, dtype.type(0), 0
+        if isinstance(weights,CompactWeights):
+            return noWeights, weights.bits, weights.dtype.type(weights.scale), 2
+        return weights, noBits, dtype.type(0), 1
+
+    def __numbaOutput(self,out,dtype):
+        if out is not None and isinstance(out,np.ndarray) and out.flags.c_contiguous and out.dtype==dtype:
+            return out
+        return np.empty([self.nVoxels, self.nS], dtype=dtype)
+
+    def __numbaColumns(self,img,add,out):
+        img = self.__numbaImage(img)
+        res = self.__numbaOutput(out,img.dtype)
+        self.__numbaCall(numbaKernels.columns, img, *self.__numbaStencil(), add, res)
+        if out is not None and res is not out:
+            out[...] = res
+            return out
+        return res
+
+    def __slabs(self,bytesPerVoxel,slabSize=None):
+        if self.voxels is not None:
+            return self.__chunks(bytesPerVoxel,slabSize)
+        if slabSize is None and self.memoryBudget is not None:
+            n,m,_ = self.imageSizeCrop
+            budget = self.memoryBudget//self.numThreads
+            slabSize = max(1, int(budget//(bytesPerVoxel*n*m)) - 2*self.stencil.pad[2])
+        if self.numThreads>1:
+            h = self.imageSizeCrop[2]
+            slabSize = min(slabSize or h, -(-h//self.numThreads))
+        return self.stencil.slabs(slabSize)
+
+    def __chunks(self,bytesPerVoxel,slabSize=None):
+        # runs of active voxels, used in place of z-slabs (slabSize in planes)
+        n,m,_ = self.imageSizeCrop
+        nRows = self.voxels.size
+        size = nRows if slabSize is None else max(1, int(slabSize))*n*m
+        if slabSize is None and self.memoryBudget is not None:
+            size = max(1, int(self.memoryBudget//self.numThreads//bytesPerVoxel))
+        if self.numThreads>1:
+            size = min(size, -(-nRows//self.numThreads))
+        return [(r, min(r+size,nRows)) for r in range(0,nRows,size)]
+
+    def __map(self,fn,slabs,collect=None):
+        # fn(z0,z1) writes its own rows of the output; its results are
+        # passed to collect (if given) in slab order
+        if self.numThreads>1 and len(slabs)>1:
+            with ThreadPoolExecutor(self.numThreads) as pool:
+                for result in pool.map(lambda s: fn(*s), slabs):
+                    if collect is not None:
+                        collect(result)
+        else:
+            for z0,z1 in slabs:
+                result = fn(z0,z1)
+                if collect is not None:
+                    collect(result)
+
+    def __rows(self,z0,z1):
+        if self.voxels is not None:
+            return slice(z0,z1)
+        nPlane = self.imageSizeCrop[0]*self.imageSizeCrop[1]
+        return slice(z0*nPlane, z1*nPlane)
+
+    def __image(self,img):
+        # cropped image on the grid, flattened in 'F' order with a mask
+        img,_ = self.imCrop(self.__cast(img))
+        img = np.reshape(img,self.imageSizeCrop)
+        return img if self.voxels is None else np.ravel(img,order='F')
+
+    def __imageOf(self,a):
+        # image from one value per row (zero outside the mask)
+        if self.voxels is not None:
+            full = np.zeros(self.stencil.nVoxels, a.dtype)
+            full[self.voxels] = a
+            a = full
+        return self.imCropUndo(a.reshape(self.imageSizeCrop,order='F'))
+
+    def __neighbourhood(self,img,z0,z1,channels=False):
+        # voxels of a slab (or run of active voxels) and a function returning
+        # their neighbours at window position l, of each image along the
+        # first axis if channels
+        if self.voxels is None:
+            padded = self.stencil.padImage(img,z0,z1,channels)
+            return img[...,z0:z1], lambda l: self.stencil.shift(padded,l)
+        coords = [c[z0:z1] for c in self.coords]
+        return img[...,self.voxels[z0:z1]], lambda l: img[...,self.stencil.neighbours(coords,l)]
+
+    def __columnsOf(self,img,op,z0,z1):
+        if self.voxels is None:
+            return self.stencil.columns(img, op, z0, z1)
+        centre, neighbour = self.__neighbourhood(img,z0,z1)
+        out = np.empty([self.nS, centre.size], dtype=img.dtype)
+        for l in range(self.nS):
+            op(neighbour(l), centre, out=out[l])
+        return out.T
+
+    def __columns(self,img,op,post,out=None):
+        # voxels x window output of op, slab by slab when a memory budget is
+        # set or out (e.g. a np.memmap) is given
+        img = self.__image(img)
+        slabs = self.__slabs(2*(self.nS+1)*img.itemsize)
+        if out is None and len(slabs)==1:
+            return post(self.__columnsOf(img, op, *slabs[0]))
+        if out is None:
+            out = np.empty([self.nVoxels, self.nS], dtype=img.dtype)
+        def slab(z0,z1):
+            out[self.__rows(z0,z1)] = post(self.__columnsOf(img, op, z0, z1))
+        self.__map(slab, slabs)
+        return out
+
+    def __zeroNaN(self,a):
+        a[np.isnan(a)] = 0
+        return a
+
+    def Grad(self,img,out=None):
+        img = self.__cast(img)
+        if self.backend=='numba':
+            return self.__numbaColumns(img, False, out)
+        return self.__columns(img, np.subtract, self.__zeroNaN, out)
     
-    def GradT(self,imgGrad):
-        dP = -2*np.sum(self.Wd*imgGrad,axis=1)
-        dP = dP.reshape(self.imageSizeCrop,order='F')
-        dP = self.imCropUndo(dP)
+    def GradT(self,imgGrad,weights=None):
+        # weights: optional voxels x window weights (dense or CompactWeights)
+        imgGrad = self.__cast(imgGrad)
+        dP = np.zeros(imgGrad.shape[0], self.__resultType(imgGrad,self.Wd))
+        if self.__numba(weights):
+            self.__numbaCall(numbaKernels.gradT, imgGrad, self.Wd, *self.__numbaWeights(weights,dP.dtype), dP)
+            dP = self.__imageOf(dP)
+            dP[np.isnan(dP)] = 0
+            return dP
+        def sparseSlab(z0,z1):
+            rows = self.__rows(z0,z1)
+            index = weights.index[rows].astype('intp')
+            w = weights.values[rows]*self.Wd[index]
+            w *= np.take_along_axis(imgGrad[rows],index,axis=1)
+            np.sum(w, axis=1, out=dP[rows])
+        def slab(z0,z1):
+            rows = self.__rows(z0,z1)
+            acc = dP[rows]
+            tmp = np.empty_like(acc)
+            for l in range(self.nS):
+                np.multiply(self.Wd[l], imgGrad[rows,l], out=tmp)
+                if weights is not None:
+                    tmp *= weights[rows,l]
+                acc += tmp
+        if isinstance(weights,SparseWeights):
+            k = weights.index.shape[1]
+            self.__map(sparseSlab, self.__slabs(k*(3*dP.itemsize+8)))
+        else:
+            self.__map(slab, self.__slabs(3*dP.itemsize))
+        dP *= -2
+        dP = self.__imageOf(dP)
         dP[np.isnan(dP)] = 0
         return dP
     
-    def Div(self,img):
-        img,_ = self.imCrop(img)
-        img = img.flatten('F')
-        imgDiv = img[self.SearchWindow] + img.reshape(-1,1)
-        imgDiv[np.isnan(imgDiv)] = 0
-        return imgDiv
+    def Div(self,img,out=None):
+        img = self.__cast(img)
+        if self.backend=='numba':
+            return self.__numbaColumns(img, True, out)
+        return self.__columns(img, np.add, self.__zeroNaN, out)
+
+    def imageReg(self,img,weights):
+        # De Pierro regularisation image 0.5*sum_k w_jk*(x_j + x_k), without
+        # forming the voxels x window neighbour values
+        img = self.__cast(img)
+        reg = np.zeros(self.nVoxels, self.__resultType(img,weights.dtype))
+        if self.__numba(weights):
+            self.__numbaCall(numbaKernels.imageReg, self.__numbaImage(img), *self.__numbaStencil(),
+                                  *self.__numbaWeights(weights,reg.dtype), reg)
+            return self.__imageOf(reg)
+        img = self.__image(img)
+        def slab(z0,z1):
+            rows = self.__rows(z0,z1)
+            centre, neighbour = self.__neighbourhood(img,z0,z1)
+            acc = reg[rows].reshape(centre.shape,order='F')
+            tmp = np.empty_like(acc)
+            for l in range(self.nS):
+                np.add(neighbour(l), centre, out=tmp)
+                tmp *= weights[rows,l].reshape(centre.shape,order='F')
+                acc += tmp
+        def sparseSlab(z0,z1):
+            # one gather per slot of the k kept neighbours
+            rows, coords, centre = self.__sparseSlab(flat,z0,z1)
+            index, values = weights.index[rows], weights.values[rows]
+            acc = reg[rows]
+            for s in range(index.shape[1]):
+                acc += values[:,s]*(flat[self.stencil.neighbours(coords,index[:,s])] + centre)
+        if isinstance(weights,SparseWeights):
+            flat = np.ravel(img,order='F')
+            self.__map(sparseSlab, self.__slabs(self.__sparseBytes(weights,reg)))
+        else:
+            self.__map(slab, self.__slabs(4*reg.itemsize))
+        reg *= 0.5
+        return self.__imageOf(reg)
     
-    def gaussianWeights(self,img,sigma):
-        return 1/np.sqrt(2*np.pi*sigma**2)*np.exp(-0.5*self.Grad(img)**2/sigma**2)
+    penalties = {'quadratic': _quadratic, 'bowsher': _quadratic,
+                 'logcosh': _logcosh, 'rdp': _relativeDifference}
+
+    def penalty(self,img,kind='quadratic',weights=None,delta=1.0,gamma=2.0,epsilon=1e-9,
+                distanceWeights=True):
+        # Value, gradient and Hessian diagonal of
+        #     R(x) = 1/2 sum_j sum_l w_jl phi(x_j, x_j+l)
+        # in a single pass over the window, with w_jl = Wd[l] times
+        # weights[j,l] if given (as in GradT). kind is 'quadratic'
+        # (phi = d**2, so the gradient is GradT(Grad(x))), 'bowsher' (the
+        # same, weights required), 'logcosh' (delta: transition) or 'rdp'
+        # (relative difference, gamma: edge preservation). Weights need not
+        # be symmetric (e.g. Bowsher weights): the gradient and Hessian
+        # diagonal use (w_jl + w_kl')/2, with w_kl' the weight of neighbour
+        # k = j+l at the opposite window position, which is exact for the
+        # periodic boundary. With a mask, w_kl' is zero for neighbours
+        # outside it (their terms are not in R). distanceWeights=False leaves
+        # out Wd (w_jl = weights[j,l]).
+        if kind not in self.penalties:
+            raise ValueError("penalty must be one of " + ", ".join(self.penalties))
+        if kind=='bowsher' and weights is None:
+            raise ValueError("Bowsher penalty needs weights")
+        potential = self.penalties[kind]
+        Wd = self.Wd if distanceWeights else np.ones_like(self.Wd)
+        img = self.__image(img)
+        grad = np.zeros(self.nVoxels, self.__resultType(img,Wd))
+        hess = np.zeros_like(grad)
+        # value terms are summed per voxel (in window order) and then over
+        # the image, so that the value does not depend on the slabs
+        values = np.zeros(self.nVoxels, 'float64')
+        rowOf = None
+        if self.voxels is not None:
+            # row of each voxel in the mask, -1 outside it
+            rowOf = np.full(self.stencil.nVoxels, -1, dtype='int64')
+            rowOf[self.voxels] = np.arange(self.voxels.size)
+        def slab(z0,z1):
+            rows = self.__rows(z0,z1)
+            xj, neighbour = self.__neighbourhood(img,z0,z1)
+            g = grad[rows].reshape(xj.shape,order='F')
+            h = hess[rows].reshape(xj.shape,order='F')
+            v = values[rows].reshape(xj.shape,order='F')
+            if weights is not None or rowOf is not None:
+                coords = self.__coordinates(z0,z1)
+            for l in range(self.nS):
+                if Wd[l]==0:
+                    continue
+                xk = neighbour(l)
+                phi, dphi, d2phi = potential(xj, xk, xj - xk, delta, gamma, epsilon)
+                w = wg = Wd[l]
+                if weights is not None:
+                    wjl = weights[rows,l]
+                    w = w*wjl.reshape(xj.shape,order='F')
+                    wg = wg*0.5*(wjl + self.__transposed(weights,coords,l,rowOf))
+                    wg = wg.reshape(xj.shape,order='F')
+                elif rowOf is not None:
+                    wg = wg*0.5*(1 + self.__transposed(weights,coords,l,rowOf))
+                    wg = wg.reshape(xj.shape,order='F')
+                v += w*phi
+                g += wg*dphi
+                h += wg*d2phi
+        def sparseSlab(z0,z1):
+            # over the k kept neighbours of each voxel; the terms of
+            # neighbours (weights are zero elsewhere) are returned, voxel by
+            # voxel, to be scattered in slab order
+            rows, coords, xj = self.__sparseSlab(flat,z0,z1)
+            index, wjl = weights.index[rows].astype('intp'), weights.values[rows]
+            ks = np.empty(index.shape, 'intp')
+            dphis = np.empty(index.shape, grad.dtype)
+            d2phis = np.empty(index.shape, grad.dtype)
+            for s in range(index.shape[1]):
+                l = index[:,s]
+                k = self.stencil.neighbours(coords,l)
+                xk = flat[k]
+                w = Wd[l]*wjl[:,s]
+                phi, dphi, d2phi = potential(xj, xk, xj - xk, delta, gamma, epsilon)
+                values[rows] += w*phi
+                w *= 0.5
+                grad[rows] += w*dphi
+                hess[rows] += w*d2phi
+                _, dphi, d2phi = potential(xk, xj, xk - xj, delta, gamma, epsilon)
+                ks[:,s] = k
+                np.multiply(w, dphi, out=dphis[:,s])
+                np.multiply(w, d2phi, out=d2phis[:,s])
+            if rowOf is None:
+                return ks.ravel(), dphis.ravel(), d2phis.ravel()
+            ks = rowOf[ks]
+            inside = ks>=0
+            return ks[inside], dphis[inside], d2phis[inside]
+        def scatter(terms):
+            # in slab order, so that sums do not depend on the slabs
+            k, dphi, d2phi = terms
+            np.add.at(gradT, k, dphi)
+            np.add.at(hessT, k, d2phi)
+        if isinstance(weights,SparseWeights):
+            flat = np.ravel(img,order='F')
+            gradT, hessT = np.zeros_like(grad), np.zeros_like(hess)
+            k = weights.index.shape[1]
+            slabs = self.__slabs(4*self.__sparseBytes(weights,grad) + k*(8 + 2*grad.itemsize))
+            self.__map(sparseSlab, slabs, scatter)
+            grad += gradT
+            hess += hessT
+        else:
+            slabs = self.__slabs(8*grad.itemsize)
+            self.__map(slab, slabs)
+        return 0.5*np.sum(values), self.__imageOf(grad), self.__imageOf(hess)
+
+    def __coordinates(self,z0,z1):
+        # grid coordinates of the voxels of a slab (or run of active voxels)
+        if self.voxels is not None:
+            return [c[z0:z1] for c in self.coords]
+        rows = self.__rows(z0,z1)
+        return self.stencil.voxelCoordinates(np.arange(rows.start,rows.stop))
+
+    def __sparseSlab(self,flat,z0,z1):
+        # rows, grid coordinates and values in the 'F' order flattened image
+        # of the voxels of a slab (or run of active voxels)
+        rows = self.__rows(z0,z1)
+        voxels = np.arange(rows.start,rows.stop) if self.voxels is None else self.voxels[rows]
+        return rows, self.stencil.voxelCoordinates(voxels), flat[voxels]
+
+    def __sparseBytes(self,weights,a):
+        # working memory per voxel of a SparseWeights slab
+        return weights.index.shape[1]*(weights.values.itemsize + weights.index.itemsize) + 8*(5 + a.itemsize)
+
+    def __transposed(self,weights,coords,l,rowOf=None):
+        # weights of the neighbours k = j+l of the voxels j at coords, at the
+        # opposite window position (offsets[nS-1-l] = -offsets[l]), 1 if
+        # weights is None; zero for neighbours outside the mask (rowOf: row
+        # of each voxel, -1 outside)
+        k = self.stencil.neighbours(coords,l)
+        if rowOf is None:
+            return weights[k,self.nS-1-l]
+        k = rowOf[k]
+        if weights is None:
+            return (k>=0).astype(self.Wd.dtype)
+        wT = weights[np.maximum(k,0),self.nS-1-l]
+        wT[k<0] = 0
+        return wT
+
+    def gaussianWeights(self,img,sigma,out=None):
+        img = self.__cast(img)
+        if self.backend=='numba':
+            img = self.__numbaImage(img)
+            res = self.__numbaOutput(out,img.dtype)
+            self.__numbaCall(numbaKernels.gaussian, img, *self.__numbaStencil(), img.dtype.type(-0.5),
+                                  img.dtype.type(sigma**2), 1/np.sqrt(2*np.pi*sigma**2), res)
+            if out is not None and res is not out:
+                out[...] = res
+                return out
+            return res
+        def gaussian(imgGrad):
+            imgGrad = self.__zeroNaN(imgGrad)
+            np.square(imgGrad, out=imgGrad)
+            imgGrad *= -0.5
+            imgGrad /= sigma**2
+            np.exp(imgGrad, out=imgGrad)
+            imgGrad *= 1/np.sqrt(2*np.pi*sigma**2)
+            return imgGrad
+        return self.__columns(img, np.subtract, gaussian, out)
     
-    def BowshserWeights(self,img,b):
+    def nonLocalWeights(self,img,h,k=10,patchSize=3,normalise=True):
+        # Non-local means weights exp(-|P_j - P_j+l|**2/(p*h**2)) between the
+        # patches (patchSize wide, p voxels) around each voxel and around its
+        # neighbours. Patch distances are box filtered (cumulative sums)
+        # squared differences, one image per window position, so the cost
+        # does not depend on patchSize and nothing voxels x window is formed.
+        # Only the k largest weights of each voxel are kept (ties going to
+        # the lowest window position, the voxel itself excluded), returned as
+        # SparseWeights that sum to 1 for each voxel unless normalise=False.
+        if k>self.nS-1:
+            raise ValueError("k must be smaller than the number of neighbours")
+        if not np.mod(patchSize,2):
+            raise ValueError("patch size must be odd")
+        img,_ = self.imCrop(self.__cast(img))
+        img = np.reshape(img,self.imageSizeCrop)
+        r = patchSize//2
+        radius = [r, r, r if self.is3D else 0]
+        modes = [self.stencil.boundaries[self.boundary]]*3
+        nPatch = np.prod([2*q+1 for q in radius])
+        # -distance of the k most similar neighbours
+        dtype = self.__resultType(img)
+        values = np.full([self.nVoxels,k], -np.inf, dtype=dtype)
+        index = np.zeros([self.nVoxels,k], dtype='uint16' if self.nS<2**16 else 'int32')
+        worst = np.full(self.nVoxels, -np.inf, dtype=dtype)
+        padded = self.stencil.padImage(img)
+        for l in range(self.nS):
+            if self.stencil.distance[l]==0:
+                continue
+            d = self.__zeroNaN(self.stencil.shift(padded,l) - img)
+            np.square(d, out=d)
+            d = -np.ravel(_boxSum(d, radius, modes), order='F')
+            if self.voxels is not None:
+                d = d[self.voxels]
+            # replace the least similar kept neighbour (the last one on ties)
+            # of the voxels for which this one is more similar
+            better = np.flatnonzero(d > worst)
+            kept = values[better]
+            ties = kept==worst[better,None]
+            slot = np.argmax(np.where(ties, index[better], np.int32(-1)), axis=1)
+            values[better,slot] = d[better]
+            index[better,slot] = l
+            worst[better] = np.min(values[better], axis=1)
+        values /= nPatch*h**2
+        if normalise:
+            # relative to the most similar neighbour, so nothing underflows
+            values -= np.max(values, axis=1, keepdims=True)
+        np.exp(values, out=values)
+        if normalise:
+            values /= np.sum(values, axis=1, keepdims=True)
+        return SparseWeights(index, values, self.nS)
+    
+    def BowshserWeights(self,img,b,slabSize=None,compact=False,out=None):
+        # b most similar neighbours of each voxel, ties going to the lowest
+        # window position; computed slabSize planes at a time (by default as
+        # many as fit the memory budget). compact=True returns CompactWeights
+        # instead of a dense 0/1 array. out: preallocated result to fill.
         if b>self.nS:
             raise ValueError("Number of most similar voxels must be smaller than number of voxels per neighbourhood")
-        imgGradAbs = np.abs(self.Grad(img))
-        Wb = 0*imgGradAbs
-        for i in range(imgGradAbs.shape[0]):
-            idx = np.argsort(imgGradAbs[i,:])
-            Wb[i,idx[0:b]]=1
+        img = self.__cast(img)
+        if out is not None:
+            Wb = out
+        elif compact:
+            Wb = CompactWeights(np.zeros([self.nVoxels, (self.nS+7)//8], dtype='uint8'), self.nS,
+                                dtype=self.dtype or 'float')
+        else:
+            Wb = np.zeros([self.nVoxels, self.nS], dtype=img.dtype)
+        if self.backend=='numba':
+            img = self.__numbaImage(img)
+            if isinstance(Wb, CompactWeights):
+                Wb.bits[...] = 0
+                self.__numbaCall(numbaKernels.bowsher, img, *self.__numbaStencil(), b, np.zeros((0,0),img.dtype), Wb.bits)
+            else:
+                Wb[...] = 0
+                self.__numbaCall(numbaKernels.bowsher, img, *self.__numbaStencil(), b, Wb, np.zeros((0,0),'uint8'))
+            return Wb
+        img = self.__image(img)
+        def slab(z0,z1):
+            imgGradAbs = self.__zeroNaN(self.__columnsOf(img, np.subtract, z0, z1))
+            np.abs(imgGradAbs, out=imgGradAbs)
+            selected = self.__smallest(imgGradAbs, b)
+            if isinstance(Wb, CompactWeights):
+                Wb.bits[self.__rows(z0,z1)] = np.packbits(selected, axis=1, bitorder='little')
+            else:
+                Wb[self.__rows(z0,z1)] = selected
+        self.__map(slab, self.__slabs(self.nS*(2*img.itemsize+11), slabSize))
         return Wb
-    
-    
-    
-    
-    
-    
-    
\ No newline at end of file
+
+    def multiChannelBowsherWeights(self,imgs,b,scales=None,slabSize=None,compact=False,out=None):
+        # Bowsher weights from several co-registered guidance images (e.g. T1
+        # and FLAIR): the b neighbours with the smallest sum_c scales[c]*|d_c|
+        # (scales default to 1), selected as in BowshserWeights, of which
+        # this is the single image case. The neighbourhood is gathered once
+        # per slab for all images; NumPy code only.
+        if b>self.nS:
+            raise ValueError("Number of most similar voxels must be smaller than number of voxels per neighbourhood")
+        imgs = np.stack([self.__image(img) for img in imgs])
+        dtype = self.__resultType(imgs)
+        scales = np.ones(len(imgs)) if scales is None else np.asarray(scales)
+        if scales.shape!=(len(imgs),):
+            raise ValueError("one scale per guidance image needed")
+        scales = scales.astype(dtype).reshape([-1]+[1]*(imgs.ndim-1))
+        if out is not None:
+            Wb = out
+        elif compact:
+            Wb = CompactWeights(np.zeros([self.nVoxels, (self.nS+7)//8], dtype='uint8'), self.nS,
+                                dtype=self.dtype or 'float')
+        else:
+            Wb = np.zeros([self.nVoxels, self.nS], dtype=dtype)
+        def slab(z0,z1):
+            centre, neighbour = self.__neighbourhood(imgs,z0,z1,channels=True)
+            dist = np.empty([self.nS, centre[0].size], dtype=dtype)
+            for l in range(self.nS):
+                d = self.__zeroNaN(neighbour(l) - centre)
+                np.abs(d, out=d)
+                d *= scales
+                dist[l] = np.ravel(np.sum(d, axis=0), order='F')
+            selected = self.__smallest(dist.T, b)
+            if isinstance(Wb, CompactWeights):
+                Wb.bits[self.__rows(z0,z1)] = np.packbits(selected, axis=1, bitorder='little')
+            else:
+                Wb[self.__rows(z0,z1)] = selected
+        bytesPerVoxel = self.nS*((len(imgs)+1)*imgs.itemsize+11)
+        self.__map(slab, self.__slabs(bytesPerVoxel, slabSize))
+        return Wb
+
+    def __smallest(self,a,b):
+        # partial selection of the b smallest entries of each row
+        kth = np.partition(a, b-1, axis=1)[:,b-1:b]
+        below = a < kth
+        tied = a == kth
+        need = b - np.sum(below, axis=1, keepdims=True)
+        return below | (tied & (np.cumsum(tied, axis=1) <= need))
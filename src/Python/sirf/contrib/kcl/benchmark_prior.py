@@ -0,0 +1,203 @@
+'''Benchmarks of the kcl priors
+Times Prior construction, Grad/GradT/Div, Gaussian and Bowsher weights and
+the De Pierro regularisation image and update (set up once, as in a
+reconstruction) on random images, for each combination of grid size,
+search window size and dtype, and records the best and mean time over the
+repeats and the peak memory (traced by tracemalloc, which does not see
+memory allocated inside numba kernels) of each operation. Results are
+printed and saved as JSON; with --baseline, times are compared to an
+earlier results file so regressions show up.
+
+Operations forming voxels x window arrays are skipped when such an array
+would exceed --max-bytes. The Bowsher weights used by the De Pierro
+operations are computed in slabs that fit it.
+
+Usage:
+  benchmark_prior [--help | options]
+
+Options:
+  -g <sizes>, --sizes=<sizes>      comma separated grid sizes nxmxh (h=1 for 2D)
+                                   [default: 64x64x1,344x344x1,64x64x64,128x128x64,344x344x127]
+  -w <wins>, --windows=<wins>      search window sizes [default: 3,5,7]
+  -d <types>, --dtypes=<types>     image types [default: float32,float64]
+  -r <reps>, --repeats=<reps>      timed runs of each operation [default: 3]
+  -t <thrs>, --threads=<thrs>      Prior numThreads [default: 1]
+  -m <bytes>, --budget=<bytes>     Prior memoryBudget in bytes
+  -b <back>, --backend=<back>      numpy or numba [default: numpy]
+  -x <bytes>, --max-bytes=<bytes>  largest voxels x window array [default: 4e9]
+  -o <file>, --output=<file>       results file [default: benchmark_prior.json]
+  -c <file>, --baseline=<file>     earlier results file to compare with
+'''
+
+## CCP PETMR Synergistic Image Reconstruction Framework (SIRF)
+## Copyright 2015 - 2017 Rutherford Appleton Laboratory STFC
+## Copyright 2015 - 2017 University College London.
+##
+## This is software developed for the Collaborative Computational
+## Project in Positron Emission Tomography and Magnetic Resonance imaging
+## (http://www.ccppetmr.ac.uk/).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+##   you may not use this file except in compliance with the License.
+##   You may obtain a copy of the License at
+##       http://www.apache.org/licenses/LICENSE-2.0
+##   Unless required by applicable law or agreed to in writing, software
+##   distributed under the License is distributed on an "AS IS" BASIS,
+##   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##   See the License for the specific language governing permissions and
+##   limitations under the License.
+
+__version__ = '0.1.0'
+from docopt import docopt
+args = docopt(__doc__, version=__version__)
+
+import json
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+
+from sirf.contrib.kcl import Prior as pr
+from sirf.contrib.kcl.dePierro import DePierroReg, DePierroUpdate
+
+# process command-line options
+sizes = [[int(s) for s in size.split('x')] for size in args['--sizes'].split(',')]
+windows = [int(w) for w in args['--windows'].split(',')]
+dtypes = args['--dtypes'].split(',')
+repeats = int(args['--repeats'])
+num_threads = int(args['--threads'])
+memory_budget = None if args['--budget'] is None else int(float(args['--budget']))
+backend = args['--backend']
+max_bytes = float(args['--max-bytes'])
+output_file = args['--output']
+baseline_file = args['--baseline']
+
+
+def measure(fn):
+    # best and mean time over the repeats, and peak traced memory of one
+    # run, after an untimed run (numba compilation, De Pierro set up)
+    fn()
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), sum(times)/len(times), peak
+
+
+def operations(size, w, dtype):
+    # (name, function, forms voxels x window arrays) for one configuration
+    rng = np.random.default_rng(0)
+    img = rng.random(size).astype(dtype)
+    sens = (rng.random(size) + 0.5).astype(dtype)
+
+    def make_prior():
+        pr.planCache.clear()
+        return pr.Prior(size, w, memoryBudget=memory_budget, numThreads=num_threads,
+                        backend=backend, dtype=dtype)
+    prior = make_prior()
+    b = min(10, prior.nS - 1)
+    state = {}
+
+    def setup():
+        # De Pierro operators, built on first use; the Bowsher weights are
+        # computed in slabs that keep the voxels x window temporaries below
+        # max_bytes
+        if 'reg' not in state:
+            n, m, _ = prior.imageSizeCrop
+            slab_size = max(1, int(max_bytes//(n*m*prior.nS*(2*img.itemsize + 11))))
+            weights = prior.BowshserWeights(img, b, slabSize=slab_size, compact=True)/float(b)
+            state['reg'] = DePierroReg(size, weights, memoryBudget=memory_budget,
+                                       numThreads=num_threads, backend=backend, dtype=dtype)
+            state['imageReg'] = state['reg'](img)
+            state['update'] = DePierroUpdate(1000.0, sens, backend=backend, dtype=dtype)
+            state['out'] = np.empty_like(img)
+        return state
+
+    def de_pierro_reg():
+        setup()['reg'](img)
+
+    def de_pierro_update():
+        # into a preallocated image, as in DePierroMAPEM
+        setup()['update'](img, state['imageReg'], out=state['out'])
+
+    def grad():
+        state['grad'] = prior.Grad(img)
+
+    def gradT():
+        if 'grad' not in state:
+            grad()
+        prior.GradT(state['grad'])
+
+    return [('construction', make_prior, False),
+            ('Grad', grad, True),
+            ('GradT', gradT, True),
+            ('Div', lambda: prior.Div(img), True),
+            ('gaussianWeights', lambda: prior.gaussianWeights(img, 0.5), True),
+            ('BowshserWeights', lambda: prior.BowshserWeights(img, b, compact=True), True),
+            ('DePierroReg', de_pierro_reg, False),
+            ('DePierroUpdate', de_pierro_update, False)]
+
+
+def main():
+
+    results = []
+    for size in sizes:
+        for w in windows:
+            nS = w**3 if size[2]>1 else w**2
+            for dtype in dtypes:
+                columns_bytes = np.prod(size)*nS*np.dtype(dtype).itemsize
+                for name, fn, forms_columns in operations(size, w, dtype):
+                    result = {'size': size, 'window': w, 'dtype': dtype, 'operation': name}
+                    if forms_columns and columns_bytes>max_bytes:
+                        result['skipped'] = 'voxels x window array of %d bytes' % columns_bytes
+                    else:
+                        best, mean, peak = measure(fn)
+                        result.update({'time': best, 'mean_time': mean, 'peak_bytes': peak})
+                    results.append(result)
+                    report(result)
+
+    with open(output_file, 'w') as f:
+        json.dump({'config': {'numpy': np.__version__, 'python': platform.python_version(),
+                              'machine': platform.machine(), 'threads': num_threads,
+                              'memory_budget': memory_budget, 'backend': backend,
+                              'repeats': repeats,
+                              'peak_bytes': 'tracemalloc: NumPy and Python allocations only, '
+                                            'not memory allocated inside numba kernels'},
+                   'results': results}, f, indent=1)
+    print('Results written to %s' % output_file)
+
+    if baseline_file is not None:
+        compare(results)
+
+
+def label(result):
+    return '%-13s w=%d %-7s %-16s' % ('x'.join(str(s) for s in result['size']),
+                                      result['window'], result['dtype'], result['operation'])
+
+
+def report(result):
+    if 'skipped' in result:
+        print('%s skipped (%s)' % (label(result), result['skipped']))
+    else:
+        print('%s %9.4f s %10.1f MB' % (label(result), result['time'], result['peak_bytes']/1e6))
+
+
+def compare(results):
+    # time relative to the baseline for the configurations run in both
+    with open(baseline_file) as f:
+        baseline = {label(r): r for r in json.load(f)['results'] if 'time' in r}
+    print('\nTime relative to %s' % baseline_file)
+    for result in results:
+        old = baseline.get(label(result))
+        if old is not None and 'time' in result:
+            ratio = result['time']/old['time']
+            print('%s %6.2f%s' % (label(result), ratio, '  <-- slower' if ratio>1.2 else ''))
+
+
+main()
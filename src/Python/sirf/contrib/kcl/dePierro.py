@@ -0,0 +1,175 @@
+'''De Pierro MAPEM building blocks
+Regularisation image and image update of De Pierro's modified MAPEM algorithm
+for weighted quadratically penalised PET image reconstruction, using the
+formulation of Wang and Qi (2015) with weights that sum to 1 for each
+neighbourhood. Shared by user_dePierroMap.py and user_dePierroMap_real_data.py.
+'''
+
+## CCP PETMR Synergistic Image Reconstruction Framework (SIRF)
+## Copyright 2015 - 2017 Rutherford Appleton Laboratory STFC
+## Copyright 2015 - 2017 University College London.
+##
+## This is software developed for the Collaborative Computational
+## Project in Positron Emission Tomography and Magnetic Resonance imaging
+## (http://www.ccppetmr.ac.uk/).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+##   you may not use this file except in compliance with the License.
+##   You may obtain a copy of the License at
+##       http://www.apache.org/licenses/LICENSE-2.0
+##   Unless required by applicable law or agreed to in writing, software
+##   distributed under the License is distributed on an "AS IS" BASIS,
+##   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##   See the License for the specific language governing permissions and
+##   limitations under the License.
+
+import numpy as np
+
+from .Prior import Prior, checkBackend, numbaKernels
+
+
+class DePierroReg(object):
+    # Regularisation image 0.5*sum_k w_jk*(x_j + x_k) for a fixed image grid
+    # and weights (dense voxels x window array or Prior.CompactWeights).
+    # Set up once per reconstruction: each call is then one gather of the
+    # padded image and one weighted sum, with no neighbourhood index.
+    # dtype: if given, weights are converted to it once and images and
+    # results are kept in it (see Prior). mask: boolean image of the voxels
+    # regularised (see Prior), weights then have one row per voxel in it.
+
+    def __init__(self, imageSize, weights, memoryBudget=None, numThreads=None, backend='numpy',
+                 dtype=None, mask=None):
+
+        # Check that weights are normalised
+        if (np.abs(np.sum(weights,axis=1)-1)>1.0e-6).any():
+            raise ValueError("Weights should sum to 1 for each voxel")
+
+        # side length of neighbourhood
+        nS = weights.shape[1]
+        is3D = len(imageSize)==3 and imageSize[2]>1
+        w = int(round(nS**(1.0/3))) if is3D else int(round(nS**0.5))
+        self.prior = Prior(imageSize, w, memoryBudget=memoryBudget, numThreads=numThreads,
+                           backend=backend, dtype=dtype, mask=mask)
+        if self.prior.nS!=nS or weights.shape[0]!=self.prior.nVoxels:
+            raise ValueError("Weights do not match a neighbourhood on this image grid")
+        if dtype is not None and weights.dtype!=dtype:
+            weights = weights.astype(dtype)
+        self.weights = weights
+        self.dtype = self.prior.dtype
+
+    def __call__(self, image):
+        return self.prior.imageReg(image, self.weights)
+
+    def penalty(self, image):
+        # sum_j sum_k w_jk*(x_j - x_k)**2; for symmetric weights the De
+        # Pierro update maximises the log-likelihood minus beta/8 times this
+        value,_,_ = self.prior.penalty(image, 'quadratic', self.weights, distanceWeights=False)
+        return 2*value
+
+
+def dePierroReg(image,weights,dtype=None,mask=None):
+    return DePierroReg(image.shape,weights,dtype=dtype,mask=mask)(image)
+
+
+class DePierroUpdate(object):
+    # Image update for a fixed beta and sensitivity image. beta_j and the
+    # clipped sensitivity are computed once (without modifying sensImg), and
+    # each call only works in preallocated buffers; out may be imageEM.
+    # backend='numba' fuses the update into two compiled passes (on
+    # numThreads numba threads, by default numba's setting). dtype: if
+    # given, beta_j and the buffers are kept in it, so that e.g. a float32
+    # update stays float32 whatever the type of beta or sensImg. mask:
+    # boolean image of the voxels updated; the others are set to zero, and
+    # beta_j and the buffers only hold the voxels in the mask.
+
+    def __init__(self, beta, sensImg, backend='numpy', dtype=None, mask=None, numThreads=None):
+
+        delta = 1e-6*abs(sensImg).max()
+        self.shape = np.shape(sensImg)
+        self.index = None
+        if mask is not None:
+            self.index = np.flatnonzero(mask)
+            sensImg = np.take(sensImg, self.index)
+        sensImg = np.maximum(sensImg, delta) # avoid division by zero
+        self.beta_j = beta/sensImg
+        if dtype is not None:
+            self.beta_j = self.beta_j.astype(dtype, copy=False)
+        self.beta_j4 = 4*self.beta_j
+        self.b_j = np.empty_like(self.beta_j)
+        self.denom = np.empty_like(self.beta_j)
+        self.tmp = np.empty_like(self.beta_j)
+        self.negative = np.empty(self.beta_j.shape, bool)
+        if self.index is not None:
+            self.imageEM = np.empty_like(self.beta_j)
+            self.imageReg = np.empty_like(self.beta_j)
+        self.backend = checkBackend(backend)
+        self.numThreads = numThreads
+
+    def __call__(self, imageEM, imageReg, out=None):
+
+        if self.index is None:
+            return self.__update(imageEM, imageReg, out)
+
+        # gather the voxels in the mask, update them and scatter back
+        np.take(imageEM, self.index, out=self.imageEM)
+        np.take(imageReg, self.index, out=self.imageReg)
+        self.__update(self.imageEM, self.imageReg, self.imageEM)
+        if out is None:
+            out = np.zeros(self.shape, self.beta_j.dtype)
+        else:
+            out.fill(0)
+        np.put(out, self.index, self.imageEM)
+        return out
+
+    def __update(self, imageEM, imageReg, out):
+
+        if self.backend=='numba' and (out is None or out.flags.c_contiguous):
+            return self.__numbaUpdate(imageEM, imageReg, out)
+
+        b_j, denom, tmp, negative = self.b_j, self.denom, self.tmp, self.negative
+
+        # b_j = 1 - beta_j*imageReg
+        np.multiply(self.beta_j, imageReg, out=b_j)
+        np.subtract(1, b_j, out=b_j)
+
+        # root = (b_j**2 + 4*beta_j*imageEM)**0.5
+        np.square(b_j, out=denom)
+        np.multiply(self.beta_j4, imageEM, out=tmp)
+        denom += tmp
+        np.sqrt(denom, out=denom)
+
+        # The update is the positive root 2*imageEM/(root + b_j), which
+        # equals (root - b_j)/(2*beta_j); the first form cancels for b_j < 0
+        # (large beta_j*imageReg), so the second is used there
+        np.subtract(denom, b_j, out=tmp)
+        tmp *= 2
+        denom += b_j
+
+        delta = 1e-6*max(denom.max(), -denom.min())
+        np.maximum(denom, delta, out=denom) # avoid division by zero
+
+        out = np.multiply(2, imageEM, out=out)
+        out /= denom
+        np.less(b_j, 0, out=negative)
+        np.divide(tmp, self.beta_j4, out=out, where=negative)
+        return out
+
+    def __numbaUpdate(self, imageEM, imageReg, out):
+
+        denom = self.denom.reshape(-1)
+        imageEM = np.ravel(imageEM)
+        numThreads = numbaKernels.numba.get_num_threads() if self.numThreads is None else self.numThreads
+        with numbaKernels.threads(numThreads):
+            numbaKernels.dePierroDenom(self.beta_j.reshape(-1), self.beta_j4.reshape(-1),
+                                       imageEM, np.ravel(imageReg), self.b_j.reshape(-1),
+                                       self.tmp.reshape(-1), denom)
+            delta = 1e-6*max(denom.max(), -denom.min())
+            if out is None:
+                out = np.empty_like(self.denom)
+            numbaKernels.dePierroImage(imageEM, self.b_j.reshape(-1), self.beta_j4.reshape(-1),
+                                       self.tmp.reshape(-1), denom, delta, out.reshape(-1))
+        return out
+
+
+def dePierroUpdate(imageEM, imageReg, beta, sensImg, dtype=None, mask=None):
+    return DePierroUpdate(beta, sensImg, dtype=dtype, mask=mask)(imageEM, imageReg)
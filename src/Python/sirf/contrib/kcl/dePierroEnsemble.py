@@ -0,0 +1,193 @@
+'''Noise-realisation ensembles of De Pierro MAPEM
+Reconstructs many Poisson noise realisations of the same expected data with
+De Pierro MAPEM, for bias and variance studies. Realisation i is drawn from
+its own seed (spawned from one SeedSequence), so any realisation can be
+reproduced on its own and results do not depend on the number of workers.
+Realisations are generated inside spawned worker processes, set up as for
+DePierroSweep, a bounded number at a time, and folded into running mean and
+variance images (Welford's algorithm) in order as they arrive, so neither
+the noisy data nor the reconstructions of the ensemble are ever held
+together in memory.
+'''
+
+## CCP PETMR Synergistic Image Reconstruction Framework (SIRF)
+## Copyright 2015 - 2017 Rutherford Appleton Laboratory STFC
+## Copyright 2015 - 2017 University College London.
+##
+## This is software developed for the Collaborative Computational
+## Project in Positron Emission Tomography and Magnetic Resonance imaging
+## (http://www.ccppetmr.ac.uk/).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+##   you may not use this file except in compliance with the License.
+##   You may obtain a copy of the License at
+##       http://www.apache.org/licenses/LICENSE-2.0
+##   Unless required by applicable law or agreed to in writing, software
+##   distributed under the License is distributed on an "AS IS" BASIS,
+##   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##   See the License for the specific language governing permissions and
+##   limitations under the License.
+
+import collections
+import multiprocessing
+import os
+
+import numpy as np
+import sirf.STIR as pet
+
+from .DePierroMAPEM import DePierroMAPEM
+from .dePierroSweep import setOMPThreads
+
+# ensemble run by a worker process
+_ensemble = None
+
+
+def _initWorker(ensemble):
+    global _ensemble
+    _ensemble = ensemble
+    setOMPThreads(ensemble.threads_per_worker)
+
+
+def _reconstruct(seed):
+    return _ensemble.reconstruct(seed).as_array()
+
+
+class RunningStatistics(object):
+    # Mean and (sample) variance of a sequence of arrays, updated one array
+    # at a time with Welford's algorithm, in float64
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, x):
+        x = np.asarray(x, dtype='float64')
+        if self.mean is None:
+            self.mean = np.zeros_like(x)
+            self.m2 = np.zeros_like(x)
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta/self.count
+        # (x - new mean)*delta, leaving x (possibly the caller's) unchanged
+        delta *= x - self.mean
+        self.m2 += delta
+
+    @property
+    def variance(self):
+        if self.count<2:
+            return np.zeros_like(self.mean)
+        return self.m2/(self.count - 1)
+
+
+class DePierroEnsemble(object):
+    # setup(*setup_args) returns the noise-free data, scaled by count_scale
+    # to the expected counts of the realisations (as
+    # np.random.poisson(acq_data.as_array()/10) in user_dePierroMap.py), the
+    # acquisition model of the objective functions, the sensitivity image,
+    # initial image and filter; it is called once in each worker process, as
+    # for DePierroSweep, where weights are put in store (a WeightStore) for
+    # the workers. kwargs: DePierroMAPEM options (num_subsets, mask, ...),
+    # numThreads defaulting to threads_per_worker. chunk_size realisations
+    # are in flight at a time (by default two per worker), a new one being
+    # submitted as each result is taken. num_workers defaults to the number
+    # of CPUs and threads_per_worker to the CPUs left to each; with one
+    # worker the realisations are reconstructed in the calling process.
+    #
+    #   ensemble = DePierroEnsemble(setup, (data_file,), weights, beta, store,
+    #                               count_scale=0.1)
+    #   stats = ensemble.run(200, seed=1)
+    #   mean, variance = stats.mean, stats.variance
+
+    def __init__(self, setup, setup_args, weights, beta, store, count_scale=1.0,
+                 num_workers=None, threads_per_worker=None, chunk_size=None, **kwargs):
+
+        self.setup = setup
+        self.setup_args = tuple(setup_args)
+        self.weights = weights
+        self.beta = beta
+        self.store = store
+        self.count_scale = count_scale
+        cpus = os.cpu_count() or 1
+        self.num_workers = max(1, cpus if num_workers is None else num_workers)
+        if threads_per_worker is None:
+            threads_per_worker = max(1, cpus//self.num_workers)
+        self.threads_per_worker = threads_per_worker
+        self.chunk_size = 2*self.num_workers if chunk_size is None else chunk_size
+        kwargs.setdefault('numThreads', threads_per_worker)
+        self.kwargs = kwargs
+        self.key = None
+        self.__unset()
+
+    def __getstate__(self):
+        # sent to the workers without the weights and SIRF objects
+        state = self.__dict__.copy()
+        state['weights'] = None
+        for name in ('acq_data', 'acq_model', 'sensitivity_image', 'image', 'filter',
+                     'expected'):
+            state[name] = None
+        return state
+
+    def __unset(self):
+        self.acq_data = None
+        self.acq_model = None
+        self.sensitivity_image = None
+        self.image = None
+        self.filter = None
+        self.expected = None
+
+    def set_up(self):
+        # data, images and (in a worker) weights of this process
+        if self.acq_data is None:
+            self.acq_data, self.acq_model, self.sensitivity_image, self.image, self.filter = \
+                self.setup(*self.setup_args)
+            self.expected = self.acq_data.as_array()*self.count_scale
+        if self.weights is None:
+            self.weights = self.store.load(self.key)
+
+    def realisation(self, seed):
+        # noisy acquisition data for a seed (a SeedSequence or integer)
+        self.set_up()
+        rng = np.random.default_rng(seed)
+        noisy_data = self.acq_data.clone()
+        noisy_data.fill(rng.poisson(self.expected))
+        return noisy_data
+
+    def reconstruct(self, seed):
+        # reconstruction of one realisation, in the calling process
+        obj_fun = pet.make_Poisson_loglikelihood(self.realisation(seed))
+        obj_fun.set_acquisition_model(self.acq_model)
+        recon = DePierroMAPEM(obj_fun, self.weights, self.beta, self.sensitivity_image,
+                              self.filter, **self.kwargs)
+        recon.set_up(self.image)
+        return recon.run(verbose=False)
+
+    def seeds(self, num_realisations, seed=None):
+        return np.random.SeedSequence(seed).spawn(num_realisations)
+
+    def run(self, num_realisations, seed=None, stats=None):
+        # RunningStatistics of the reconstructions; pass stats from an
+        # earlier run (with another seed) to add realisations to it
+        stats = RunningStatistics() if stats is None else stats
+        seeds = self.seeds(num_realisations, seed)
+        if self.num_workers==1:
+            try:
+                for s in seeds:
+                    stats.update(self.reconstruct(s).as_array())
+            finally:
+                self.__unset()
+            return stats
+        self.key = self.store.put(self.weights)
+        pool = multiprocessing.get_context('spawn').Pool \
+            (self.num_workers, initializer=_initWorker, initargs=(self,))
+        with pool:
+            # one realisation submitted per result taken, in order, so
+            # that the statistics do not depend on timing
+            pending = collections.deque()
+            for s in seeds:
+                pending.append(pool.apply_async(_reconstruct, (s,)))
+                if len(pending)>=self.chunk_size:
+                    stats.update(pending.popleft().get())
+            while pending:
+                stats.update(pending.popleft().get())
+        return stats
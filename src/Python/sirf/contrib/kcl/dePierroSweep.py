@@ -0,0 +1,157 @@
+'''Parameter sweeps of De Pierro MAPEM
+Runs DePierroMAPEM for every combination of beta and a set of named weights
+(e.g. uniform and Bowsher weights for several b) in a pool of worker
+processes. SIRF objects cannot be pickled, and forked children of a process
+that has run OpenMP parallel regions hang with GCC's runtime (loaded with
+sirf.STIR), so workers are spawned: each sets up its own objective function,
+sensitivity and initial images with a given setup function, once for all its
+reconstructions, and reads the weights memory-mapped from a WeightStore, so
+that the workers share one copy. Only the reconstructed image arrays are sent
+back. Each worker is given its own OpenMP thread budget, so that the workers
+together do not oversubscribe the machine.
+'''
+
+## CCP PETMR Synergistic Image Reconstruction Framework (SIRF)
+## Copyright 2015 - 2017 Rutherford Appleton Laboratory STFC
+## Copyright 2015 - 2017 University College London.
+##
+## This is software developed for the Collaborative Computational
+## Project in Positron Emission Tomography and Magnetic Resonance imaging
+## (http://www.ccppetmr.ac.uk/).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+##   you may not use this file except in compliance with the License.
+##   You may obtain a copy of the License at
+##       http://www.apache.org/licenses/LICENSE-2.0
+##   Unless required by applicable law or agreed to in writing, software
+##   distributed under the License is distributed on an "AS IS" BASIS,
+##   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##   See the License for the specific language governing permissions and
+##   limitations under the License.
+
+import multiprocessing
+import os
+
+import sirf.STIR as pet
+
+from .DePierroMAPEM import DePierroMAPEM
+
+# sweep run by a worker process
+_sweep = None
+
+
+def setOMPThreads(numThreads):
+    # thread budget of a worker process, set before its first parallel
+    # region (OMP_NUM_THREADS would be ignored, sirf.STIR being imported)
+    if hasattr(pet, 'set_max_omp_threads'):
+        pet.set_max_omp_threads(numThreads)
+
+
+def _initWorker(sweep):
+    global _sweep
+    _sweep = sweep
+    setOMPThreads(sweep.threads_per_worker)
+
+
+def _reconstruct(job):
+    name, beta = job
+    return name, beta, _sweep.reconstruct(name, beta).as_array()
+
+
+class DePierroSweep(object):
+    # setup(*setup_args) returns the objective function (with its acquisition
+    # model), sensitivity image, initial image and filter of the
+    # reconstructions; it is called once in each worker process, so it must
+    # be importable there (a module-level function, of a script guarded by
+    # if __name__ == '__main__') and setup_args picklable, e.g. file names.
+    # weights is a dict of name: normalised weights, put in store (a
+    # WeightStore) for the workers. The DePierroMAPEM options in kwargs
+    # (num_subsets, num_subiterations, mask, ...) are shared by all
+    # reconstructions, numThreads defaulting to threads_per_worker.
+    # num_workers defaults to the number of combinations (at most the number
+    # of CPUs) and threads_per_worker to the CPUs left to each; with one
+    # worker the reconstructions run in the calling process. monitor is a
+    # (picklable) factory of ConvergenceMonitor.
+    #
+    #   sweep = DePierroSweep(setup, (data_file,), weights, betas, store)
+    #   images = sweep.run()     # {(name, beta): array}
+    #   sweep.write(images, template_image, 'dePierro')
+
+    def __init__(self, setup, setup_args, weights, betas, store,
+                 num_workers=None, threads_per_worker=None, monitor=None, **kwargs):
+
+        self.setup = setup
+        self.setup_args = tuple(setup_args)
+        self.weights = weights
+        self.betas = list(betas)
+        self.store = store
+        self.monitor = monitor
+        self.jobs = [(name, beta) for name in weights for beta in self.betas]
+        cpus = os.cpu_count() or 1
+        if num_workers is None:
+            num_workers = min(len(self.jobs), cpus)
+        self.num_workers = max(1, num_workers)
+        if threads_per_worker is None:
+            threads_per_worker = max(1, cpus//self.num_workers)
+        self.threads_per_worker = threads_per_worker
+        kwargs.setdefault('numThreads', threads_per_worker)
+        self.kwargs = kwargs
+        self.keys = None
+        self.__unset()
+
+    def __getstate__(self):
+        # sent to the workers without the weights and SIRF objects
+        state = self.__dict__.copy()
+        state['weights'] = None
+        for name in ('obj_fun', 'sensitivity_image', 'image', 'filter'):
+            state[name] = None
+        return state
+
+    def __unset(self):
+        self.obj_fun = None
+        self.sensitivity_image = None
+        self.image = None
+        self.filter = None
+
+    def set_up(self):
+        # objective function, images and (in a worker) weights of this process
+        if self.obj_fun is None:
+            self.obj_fun, self.sensitivity_image, self.image, self.filter = \
+                self.setup(*self.setup_args)
+        if self.weights is None:
+            self.weights = dict((name, self.store.load(key)) for name, key in self.keys.items())
+
+    def reconstruct(self, name, beta):
+        # one reconstruction, in the calling process (a fresh monitor is
+        # needed for each run)
+        self.set_up()
+        recon = DePierroMAPEM(self.obj_fun, self.weights[name], beta, self.sensitivity_image,
+                              self.filter, **self.kwargs)
+        recon.set_up(self.image)
+        monitor = None if self.monitor is None else self.monitor()
+        return recon.run(verbose=False, monitor=monitor)
+
+    def run(self):
+        images = {}
+        if self.num_workers==1:
+            try:
+                for name, beta in self.jobs:
+                    images[(name, beta)] = self.reconstruct(name, beta).as_array()
+            finally:
+                self.__unset()
+            return images
+        self.keys = dict((name, self.store.put(w)) for name, w in self.weights.items())
+        pool = multiprocessing.get_context('spawn').Pool \
+            (self.num_workers, initializer=_initWorker, initargs=(self,))
+        with pool:
+            for name, beta, array in pool.imap_unordered(_reconstruct, self.jobs):
+                images[(name, beta)] = array
+        return images
+
+    def write(self, images, image, prefix):
+        # one file per reconstruction, e.g. prefix_bowsher10_beta5000.hv,
+        # with the geometry of image
+        for (name, beta), array in sorted(images.items()):
+            result = image.clone()
+            result.fill(array)
+            result.write('%s_%s_beta%g.hv' % (prefix, name, beta))
@@ -0,0 +1,198 @@
+'''Numba kernels for Prior and the De Pierro functions
+Each kernel loops directly over voxels (in parallel) and window offsets,
+reading neighbours through a Stencil's padded index, so no neighbour or
+difference arrays are formed and any boundary mode works. Voxels are
+numbered in 'F' order, as in Prior. Weights are passed as a dense voxels x
+window array (mode 1) or CompactWeights bits and scale (mode 2); mode 0
+means no weights. voxels lists the voxels ('F' order) to work on, one
+output row each, or is empty for all voxels. Only imported when numba is
+installed.
+'''
+
+## CCP PETMR Synergistic Image Reconstruction Framework (SIRF)
+## Copyright 2015 - 2017 Rutherford Appleton Laboratory STFC
+## Copyright 2015 - 2017 University College London.
+##
+## This is software developed for the Collaborative Computational
+## Project in Positron Emission Tomography and Magnetic Resonance imaging
+## (http://www.ccppetmr.ac.uk/).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+##   you may not use this file except in compliance with the License.
+##   You may obtain a copy of the License at
+##       http://www.apache.org/licenses/LICENSE-2.0
+##   Unless required by applicable law or agreed to in writing, software
+##   distributed under the License is distributed on an "AS IS" BASIS,
+##   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##   See the License for the specific language governing permissions and
+##   limitations under the License.
+
+from contextlib import contextmanager
+
+import numba
+import numpy as np
+
+
+def setThreads(numThreads):
+    numba.set_num_threads(max(1, min(numThreads, numba.config.NUMBA_NUM_THREADS)))
+
+
+@contextmanager
+def threads(numThreads):
+    # numba threads of the kernels called in the block (the setting is
+    # per calling thread), restored afterwards
+    previous = numba.get_num_threads()
+    setThreads(numThreads)
+    try:
+        yield
+    finally:
+        numba.set_num_threads(previous)
+
+
+@numba.njit(parallel=True, cache=True)
+def columns(img, xi, yi, zi, offsets, voxels, add, out):
+    # out[v,l] = neighbour +/- voxel, NaN set to 0 (Prior.Grad/Div)
+    n, m, h = img.shape
+    nRows = voxels.size if voxels.size > 0 else n*m*h
+    for r in numba.prange(nRows):
+        v = voxels[r] if voxels.size > 0 else np.int64(r)
+        i = v % n
+        j = (v//n) % m
+        k = v//(n*m)
+        c = img[i,j,k]
+        for l in range(offsets.shape[0]):
+            x = img[xi[i+offsets[l,0]], yi[j+offsets[l,1]], zi[k+offsets[l,2]]]
+            d = x + c if add else x - c
+            out[r,l] = 0 if d != d else d
+
+
+@numba.njit(parallel=True, cache=True)
+def gaussian(img, xi, yi, zi, offsets, voxels, minusHalf, sigma2, norm, out):
+    # out[v,l] = norm*exp(-0.5*d**2/sigma**2) (Prior.gaussianWeights)
+    n, m, h = img.shape
+    nRows = voxels.size if voxels.size > 0 else n*m*h
+    for r in numba.prange(nRows):
+        v = voxels[r] if voxels.size > 0 else np.int64(r)
+        i = v % n
+        j = (v//n) % m
+        k = v//(n*m)
+        c = img[i,j,k]
+        for l in range(offsets.shape[0]):
+            d = img[xi[i+offsets[l,0]], yi[j+offsets[l,1]], zi[k+offsets[l,2]]] - c
+            if d != d:
+                d = 0
+            out[r,l] = np.exp(d*d*minusHalf/sigma2)*norm
+
+
+@numba.njit(parallel=True, cache=True)
+def bowsher(img, xi, yi, zi, offsets, voxels, b, out, bits):
+    # b smallest |neighbour - voxel| per voxel, ties to the lowest window
+    # position, kept by insertion into a sorted list; written as 1s into a
+    # zeroed dense out or as set bits (Prior.BowshserWeights)
+    n, m, h = img.shape
+    dense = out.shape[0] > 0
+    nRows = voxels.size if voxels.size > 0 else n*m*h
+    for r in numba.prange(nRows):
+        v = voxels[r] if voxels.size > 0 else np.int64(r)
+        i = v % n
+        j = (v//n) % m
+        k = v//(n*m)
+        c = img[i,j,k]
+        best = np.empty(b, dtype=img.dtype)
+        idx = np.empty(b, dtype=np.int64)
+        count = 0
+        for l in range(offsets.shape[0]):
+            d = img[xi[i+offsets[l,0]], yi[j+offsets[l,1]], zi[k+offsets[l,2]]] - c
+            if d != d:
+                d = 0
+            a = abs(d)
+            if count < b:
+                p = count
+                count += 1
+            elif a < best[b-1]:
+                p = b-1
+            else:
+                continue
+            while p > 0 and best[p-1] > a:
+                best[p] = best[p-1]
+                idx[p] = idx[p-1]
+                p -= 1
+            best[p] = a
+            idx[p] = l
+        for q in range(b):
+            l = idx[q]
+            if dense:
+                out[r,l] = 1
+            else:
+                bits[r,l >> 3] |= np.uint8(1 << (l & 7))
+
+
+@numba.njit(parallel=True, cache=True)
+def gradT(imgGrad, Wd, W, bits, scale, mode, out):
+    # out[v] = -2*sum_l Wd[l]*w_vl*imgGrad[v,l] (Prior.GradT), out zeroed
+    for v in numba.prange(imgGrad.shape[0]):
+        acc = out[v]
+        for l in range(imgGrad.shape[1]):
+            t = Wd[l]*imgGrad[v,l]
+            if mode == 1:
+                t = t*W[v,l]
+            elif mode == 2:
+                t = t*(scale if (bits[v,l >> 3] >> (l & 7)) & 1 else 0*scale)
+            acc += t
+        out[v] = acc*-2
+
+
+@numba.njit(parallel=True, cache=True)
+def imageReg(img, xi, yi, zi, offsets, voxels, W, bits, scale, mode, out):
+    # out[v] = 0.5*sum_l w_vl*(neighbour + voxel) (Prior.imageReg), out zeroed
+    n, m, h = img.shape
+    nRows = voxels.size if voxels.size > 0 else n*m*h
+    for r in numba.prange(nRows):
+        v = voxels[r] if voxels.size > 0 else np.int64(r)
+        i = v % n
+        j = (v//n) % m
+        k = v//(n*m)
+        c = img[i,j,k]
+        acc = out[r]
+        for l in range(offsets.shape[0]):
+            if mode == 1:
+                w = W[r,l]
+            elif (bits[r,l >> 3] >> (l & 7)) & 1:
+                w = scale
+            else:
+                continue
+            acc += (img[xi[i+offsets[l,0]], yi[j+offsets[l,1]], zi[k+offsets[l,2]]] + c)*w
+        out[r] = 0.5*acc
+
+
+@numba.njit(parallel=True, cache=True)
+def dePierroDenom(beta_j, beta_j4, imageEM, imageReg, b_j, tmp, denom):
+    # b_j = 1 - beta_j*imageReg, root = (b_j**2 + 4*beta_j*imageEM)**0.5,
+    # tmp = 2*(root - b_j), denom = root + b_j; in the type of the buffers
+    # and rounded as the numpy steps of DePierroUpdate (a bare literal would
+    # promote float32 to float64)
+    one = denom.dtype.type(1)
+    for i in numba.prange(denom.size):
+        b_j[i] = one - beta_j[i]*imageReg[i]
+        b = b_j[i]
+        denom[i] = beta_j4[i]*imageEM[i]
+        root = np.sqrt(b*b + denom[i])
+        t = root - b
+        tmp[i] = t + t
+        denom[i] = root + b
+
+
+@numba.njit(parallel=True, cache=True)
+def dePierroImage(imageEM, b_j, beta_j4, tmp, denom, delta, out):
+    # out = 2*imageEM/denom, denom clipped below at delta, or for b_j < 0
+    # the cancellation-free tmp/(4*beta_j) = (root - b_j)/(2*beta_j)
+    two = out.dtype.type(2)
+    delta = denom.dtype.type(delta)
+    for i in numba.prange(out.size):
+        if b_j[i] < 0:
+            out[i] = tmp[i]/beta_j4[i]
+            continue
+        d = denom[i]
+        if d < delta:
+            d = delta
+        out[i] = two*imageEM[i]/d
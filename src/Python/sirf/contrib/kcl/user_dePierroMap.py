@@ -41,15 +41,16 @@ __version__ = '0.1.0'
 from docopt import docopt
 args = docopt(__doc__, version=__version__)
 
-from pUtilities import show_2D_array
+from sirf.Utilities import show_2D_array
 
 import numpy as np
 
-import Prior as pr  # Import Python Prior class by Abi
-import pSTIR as pet
+from sirf.contrib.kcl import Prior as pr  # Import Python Prior class by Abi
+from sirf.contrib.kcl.DePierroMAPEM import DePierroMAPEM
+import sirf.STIR as pet
 
 # import engine module
-exec('from p' + args['--engine'] + ' import *')
+exec('from sirf.' + args['--engine'] + ' import *')
 
 # process command-line options
 num_subsets = int(args['--subs'])
@@ -60,120 +61,17 @@ if data_path is None:
     data_path = petmr_data_path('pet')
 raw_data_file = existing_filepath(data_path, data_file)
 
-def my_dePierroMap(image, obj_fun, beta, filter, num_subsets, num_subiterations, weights, sensitivity_image):
+def my_dePierroMap(image, obj_fun, beta, filter, num_subsets, num_subiterations, weights, sensitivity_image,
+                   mask=None):
     
-    # Check that weights are normalised
-    if (np.abs(np.sum(weights,axis=1)-1)>1.0e-6).any():
-        raise ValueError("Weights should sum to 1 for each voxel")
-        
-    # Create OSEM reconstructor
-    OSEM_reconstructor = pet.OSMAPOSLReconstructor()
-    OSEM_reconstructor.set_output_filename_prefix('subiter')
-    OSEM_reconstructor.set_objective_function(obj_fun)
-    OSEM_reconstructor.set_num_subsets(num_subsets)
-    OSEM_reconstructor.set_num_subiterations(num_subiterations)    
-    OSEM_reconstructor.set_up(image)
-    
-    current_image = image.clone()
-
-    for iter in range(1,num_subiterations + 1):
-        print('\n------------- Subiteration %d' % iter) 
-        
-        # Calculate imageReg and return as an array
-        imageReg_array = dePierroReg(current_image.as_array(),weights)
-
-        # OSEM image update
-        OSEM_reconstructor.update(current_image)
-        imageEM_array = current_image.as_array()
-        
-        # Final image update
-        imageUpdated_array = dePierroUpdate \
-            (imageEM_array, imageReg_array, beta, sensitivity_image.as_array())
-        
-        # Fill image and truncate to cylindrical field of view        
-        current_image.fill(imageUpdated_array)
-        filter.apply(current_image)
-        
-    image_out = current_image.clone()
-    return image_out
+    # De Pierro MAPEM reconstructor (sets up the regularisation operator and
+    # image update once for all subiterations)
+    reconstructor = DePierroMAPEM(obj_fun, weights, beta, sensitivity_image, filter,
+                                  num_subsets, num_subiterations, mask=mask)
+    reconstructor.set_up(image)
+    return reconstructor.run()
 
 
-def dePierroUpdate(imageEM, imageReg, beta, sensImg):
-    
-    delta = 1e-6*abs(sensImg).max()
-    sensImg[sensImg < delta] = delta # avoid division by zero
-    beta_j = beta/sensImg
-    
-    b_j = 1 - beta_j*imageReg
-    
-    numer = (2*imageEM)
-    denom = ((b_j**2 + 4*beta_j*imageEM)**0.5 + b_j)
-    
-    delta = 1e-6*abs(denom).max()
-    denom[denom < delta] = delta # avoid division by zero
-    
-    imageUpdated = numer/denom
-    
-    return imageUpdated
-
-def dePierroReg(image,weights):
-    
-    # get size and vectorise image for indexing 
-    imSize = image.shape
-    imageVec = image.reshape(-1,1,order='F').flatten('F')
-    
-    # get the neigbourhoods of each voxel
-    weightsSize = weights.shape
-    w = int(round(weightsSize[1]**(1.0/3))) # side length of neighbourhood
-    nhoodInd    = neighbourExtract(imSize,w)
-    nhoodIndVec = nhoodInd.reshape(-1,1,order='F').flatten('F')
-    
-    # retrieve voxel intensities for neighbourhoods 
-    resultVec = imageVec[nhoodIndVec]
-    result = resultVec.reshape(nhoodInd.shape,order='F')
-    
-    # compute xreg
-    imageReg = 0.5*np.sum(weights*(result + image.reshape(-1,1,order='F')),axis=1)
-    imageReg = imageReg.reshape(imSize,order='F')
-    
-    return imageReg
-
-def neighbourExtract(imageSize,w):
-    # Adapted from Prior class        
-    n = imageSize[0]
-    m = imageSize[1]
-    h = imageSize[2]
-    wlen = 2*np.floor(w/2)
-    widx = xidx = yidx = np.arange(-wlen/2,wlen/2+1)
-
-    if h==1:
-        zidx = [0]
-        nN = w*w
-    else:
-        zidx = widx
-        nN = w*w*w
-        
-    Y,X,Z = np.meshgrid(np.arange(0,m), np.arange(0,n), np.arange(0,h))                
-    N = np.zeros([n*m*h, nN],dtype='int32')
-    l = 0
-    for x in xidx:
-        Xnew = setBoundary(X + x,n)
-        for y in yidx:
-            Ynew = setBoundary(Y + y,m)
-            for z in zidx:
-                Znew = setBoundary(Z + z,h)
-                N[:,l] = ((Xnew + (Ynew)*n + (Znew)*n*m)).reshape(-1,1).flatten('F')
-                l += 1
-    return N
-    
-def setBoundary(X,n):
-    # Boundary conditions for neighbourExtract
-    # Adapted from Prior class
-    idx = X<0
-    X[idx] = X[idx] + n
-    idx = X>n-1
-    X[idx] = X[idx] - n
-    return X.flatten('F')
     
 
 def main():
@@ -181,6 +79,9 @@ def main():
     # output goes to files
     msg_red =pet.MessageRedirector('info.txt', 'warn.txt', 'errr.txt')
 
+    # keep acquisition data in memory (no temporary files)
+    pet.AcquisitionData.set_storage_scheme('memory')
+
     # create acquisition model
     acq_model = pet.AcquisitionModelUsingRayTracingMatrix()
 
@@ -224,26 +125,31 @@ def main():
     obj_fun3.set_num_subsets(num_subsets)
     obj_fun3.set_up(image)    
 
+    # the filter keeps the cylindrical field of view, so the prior and the
+    # De Pierro update only work on the voxels inside it
+    mask = pr.cylinderMask(sensitivity_image.as_array().shape)
+
+    # create a Prior for computing Bowsher weights (float32, as the images)
+    myPrior = pr.Prior(sensitivity_image.as_array().shape, dtype='float32', mask=mask)
+
     # uniform weights
-    weightsUniform = np.ones([sensitivity_image.as_array().size,27],dtype='float')
+    weightsUniform = pr.CompactWeights.full(myPrior.nVoxels,27,dtype='float32')
     weightsUniform = weightsUniform/27.0
     
     # noise free recon with beta = 0 for guidance   
     image_noiseFree = my_dePierroMap \
-        (image, obj_fun3, 0, filter, num_subsets, num_subiterations, weightsUniform, sensitivity_image)
+        (image, obj_fun3, 0, filter, num_subsets, num_subiterations, weightsUniform, sensitivity_image, mask)
     
-    # create a Prior for computing Bowsher weights
-    myPrior = pr.Prior(sensitivity_image.as_array().shape)
-    weightsBowsher = myPrior.BowshserWeights(image_noiseFree.as_array(),10)
-    weightsBowsher = np.float64(weightsBowsher/10.0)
+    weightsBowsher = myPrior.BowshserWeights(image_noiseFree.as_array(),10,compact=True)
+    weightsBowsher = weightsBowsher/10.0
     
     # dePierro MAPEM with uniform and Bowsher weights
     beta = 5000.0
     image_dp_b = my_dePierroMap \
-        (image, obj_fun, beta, filter, num_subsets, num_subiterations, weightsBowsher, sensitivity_image)
+        (image, obj_fun, beta, filter, num_subsets, num_subiterations, weightsBowsher, sensitivity_image, mask)
     
     image_dp_u = my_dePierroMap \
-        (image, obj_fun, beta, filter, num_subsets, num_subiterations, weightsUniform, sensitivity_image)
+        (image, obj_fun, beta, filter, num_subsets, num_subiterations, weightsUniform, sensitivity_image, mask)
 
     # show reconstructed images at z = 20    
     image_dp_b_array = image_dp_b.as_array()
@@ -0,0 +1,168 @@
+'''De Pierro MAPEM noise-realisation ensemble
+Reconstructs Poisson noise realisations of the data of user_dePierroMap.py
+(expected counts a tenth of the noise-free data, as there) with De Pierro
+MAPEM and Bowsher weights from a noise-free reconstruction, in parallel
+worker processes, and writes the mean and variance images of the ensemble.
+Each worker reads the data and the sensitivity image written by the script,
+and the weights from a weight store.
+Realisation i uses the i-th seed spawned from --seed, so runs are
+reproducible whatever the number of workers.
+
+Usage:
+  dePierroMap_ensemble [--help | options]
+
+Options:
+  -f <file>, --file=<file>    raw data file
+                              [default: my_forward_projection.hs]
+  -p <path>, --path=<path>    path to data files, defaults to data/examples/PET
+                              subfolder of SIRF root folder
+  -s <subs>, --subs=<subs>    number of subsets [default: 12]
+  -i <siter>, --subiter=<siter>    number of sub-iterations [default: 24]
+  -n <real>, --realisations=<real>  number of noise realisations [default: 100]
+  -b <beta>, --beta=<beta>    penalty strength [default: 5000]
+  -r <seed>, --seed=<seed>    seed of the ensemble [default: 1]
+  -w <wrks>, --workers=<wrks>  worker processes, defaults to the number of CPUs
+  -t <thrs>, --threads=<thrs>  OpenMP threads per worker, defaults to the
+                              CPUs shared between the workers
+  -c <chnk>, --chunk=<chnk>   realisations in flight at a time, defaults to
+                              two per worker
+  -o <pref>, --output=<pref>  prefix of the output images and sensitivity
+                              image [default: ensemble]
+  -d <dir>, --store=<dir>     directory of the weight store [default: weights]
+'''
+
+## CCP PETMR Synergistic Image Reconstruction Framework (SIRF)
+## Copyright 2015 - 2017 Rutherford Appleton Laboratory STFC
+## Copyright 2015 - 2017 University College London.
+##
+## This is software developed for the Collaborative Computational
+## Project in Positron Emission Tomography and Magnetic Resonance imaging
+## (http://www.ccppetmr.ac.uk/).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+##   you may not use this file except in compliance with the License.
+##   You may obtain a copy of the License at
+##       http://www.apache.org/licenses/LICENSE-2.0
+##   Unless required by applicable law or agreed to in writing, software
+##   distributed under the License is distributed on an "AS IS" BASIS,
+##   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##   See the License for the specific language governing permissions and
+##   limitations under the License.
+
+__version__ = '0.1.0'
+from docopt import docopt
+args = docopt(__doc__, version=__version__)
+
+from sirf.Utilities import existing_filepath, petmr_data_path
+from sirf.contrib.kcl import Prior as pr
+from sirf.contrib.kcl.DePierroMAPEM import DePierroMAPEM
+from sirf.contrib.kcl.dePierroEnsemble import DePierroEnsemble
+from sirf.contrib.kcl.weightStore import WeightStore
+import sirf.STIR as pet
+
+# process command-line options
+num_subsets = int(args['--subs'])
+num_subiterations = int(args['--subiter'])
+data_file = args['--file']
+data_path = args['--path']
+if data_path is None:
+    data_path = petmr_data_path('pet')
+raw_data_file = existing_filepath(data_path, data_file)
+num_realisations = int(args['--realisations'])
+beta = float(args['--beta'])
+seed = int(args['--seed'])
+num_workers = None if args['--workers'] is None else int(args['--workers'])
+threads_per_worker = None if args['--threads'] is None else int(args['--threads'])
+chunk_size = None if args['--chunk'] is None else int(args['--chunk'])
+output_prefix = args['--output']
+store_dir = args['--store']
+
+
+def make_image(filter):
+
+    # create initial image estimate
+    image_size = (111, 111, 31)
+    voxel_size = (3, 3, 3.375) # voxel sizes are in mm
+    image = pet.ImageData()
+    image.initialise(image_size, voxel_size)
+    image.fill(1.0)
+    filter.apply(image)
+    return image
+
+def set_up_ensemble(sensitivity_file):
+
+    # data, acquisition model, images and filter of the reconstructions of
+    # a worker process of the ensemble
+    pet.AcquisitionData.set_storage_scheme('memory')
+    filter = pet.TruncateToCylinderProcessor()
+    return pet.AcquisitionData(raw_data_file), pet.AcquisitionModelUsingRayTracingMatrix(), \
+        pet.ImageData(sensitivity_file), make_image(filter), filter
+
+def main():
+
+    # output goes to files
+    msg_red = pet.MessageRedirector('info.txt', 'warn.txt', 'errr.txt')
+
+    # keep acquisition data in memory (no temporary files)
+    pet.AcquisitionData.set_storage_scheme('memory')
+
+    # create acquisition model
+    acq_model = pet.AcquisitionModelUsingRayTracingMatrix()
+
+    # PET acquisition data to be read from the file specified by --file option
+    print('raw data: %s' % raw_data_file)
+    acq_data = pet.AcquisitionData(raw_data_file)
+
+    # create filter that zeroes the image outside a cylinder of the same
+    # diameter as the image xy-section size
+    filter = pet.TruncateToCylinderProcessor()
+
+    # create initial image estimate
+    image = make_image(filter)
+
+    # noise-free objective function, for the sensitivity image and guidance
+    obj_fun = pet.make_Poisson_loglikelihood(acq_data)
+    obj_fun.set_acquisition_model(acq_model)
+    obj_fun.set_num_subsets(1)
+    obj_fun.set_up(image)
+    sensitivity_image = obj_fun.get_subset_sensitivity(0)
+    sensitivity_file = output_prefix + '_sensitivity.hv'
+    sensitivity_image.write(sensitivity_file)
+
+    # the prior and the De Pierro update only work on the field of view
+    mask = pr.cylinderMask(sensitivity_image.as_array().shape)
+    myPrior = pr.Prior(sensitivity_image.as_array().shape, dtype='float32', mask=mask)
+    weightsUniform = pr.CompactWeights.full(myPrior.nVoxels,27,dtype='float32')/27.0
+
+    # noise free recon with beta = 0 for guidance
+    reconstructor = DePierroMAPEM(obj_fun, weightsUniform, 0, sensitivity_image, filter,
+                                  num_subsets, num_subiterations, mask=mask)
+    reconstructor.set_up(image)
+    guidance = reconstructor.run(verbose=False).as_array()
+    weightsBowsher = myPrior.BowshserWeights(guidance,10,compact=True)/10.0
+
+    # reconstruct the realisations, keeping only running statistics
+    ensemble = DePierroEnsemble(set_up_ensemble, (sensitivity_file,), weightsBowsher, beta,
+                                WeightStore(store_dir), count_scale=0.1,
+                                num_workers=num_workers, threads_per_worker=threads_per_worker,
+                                chunk_size=chunk_size, num_subsets=num_subsets,
+                                num_subiterations=num_subiterations, mask=mask)
+    print('Reconstructing %d realisations on %d workers with %d threads each'
+          % (num_realisations, ensemble.num_workers, ensemble.threads_per_worker))
+    stats = ensemble.run(num_realisations, seed)
+
+    for name, array in (('mean', stats.mean), ('variance', stats.variance)):
+        result = image.clone()
+        result.fill(array)
+        result.write('%s_%s.hv' % (output_prefix, name))
+
+# (the workers of the ensemble import this script without running it)
+if __name__ == '__main__':
+    # if anything goes wrong, an exception will be thrown
+    # (cf. Error Handling section in the spec)
+    try:
+        main()
+        print('done')
+    except pet.error as err:
+        # display error information
+        print('%s' % err.value)
@@ -37,138 +37,30 @@ Options:
 
 __version__ = '0.1.0'
 
-def my_dePierroMap(image, obj_fun, beta, filter, weights, sensitivity_image):
+def my_dePierroMap(image, obj_fun, beta, filter, weights, sensitivity_image, mask=None):
     
-    # Check that weights are normalised
-    if (np.abs(np.sum(weights,axis=1)-1)>1.0e-6).any():
-        raise ValueError("Weights should sum to 1 for each voxel")
-        
-    # Create OSEM reconstructor
+    # De Pierro MAPEM reconstructor; everything stays in memory, so no
+    # temporary files need clearing from the current working directory
     print('Setting up reconstruction object')
-    OSEM_reconstructor = OSMAPOSLReconstructor()
-    OSEM_reconstructor.set_objective_function(obj_fun)                             
-    OSEM_reconstructor.set_num_subsets(21)
-    OSEM_reconstructor.set_num_subiterations(21*10)
-    OSEM_reconstructor.set_up(image)
-    num_subiterations = OSEM_reconstructor.get_num_subiterations()
-    
-    current_image = image.clone()
-
-    for iter in range(1,num_subiterations + 1):
-        print('\n------------- Subiteration %d' % iter) 
-
-        # clear the temp files from the current working directory (vital when
-        # reconstructing real datasets with many iterations)
-        if np.mod(iter,5) == 0:
-            os.system('rm *.hv *.hs *.v *.s *.ahv')
-        
-        # Calculate imageReg and return as an array
-        imageReg_array = dePierroReg(current_image.as_array(),weights)
-        
-        # OSEM image update
-        OSEM_reconstructor.update(current_image)
-        imageEM_array = current_image.as_array()
-        
-        # Final image update
-        imageUpdated_array = dePierroUpdate \
-            (imageEM_array, imageReg_array, beta, sensitivity_image.as_array())
-        
-        # Fill image and truncate to cylindrical field of view        
-        current_image.fill(imageUpdated_array)
-        filter.apply(current_image)
-        
-    image_out = current_image.clone()
-    return image_out
-
-
-def dePierroUpdate(imageEM, imageReg, beta, sensImg):
-    
-    delta = 1e-6*abs(sensImg).max()
-    sensImg[sensImg < delta] = delta # avoid division by zero
-    beta_j = beta/sensImg
-    
-    b_j = 1 - beta_j*imageReg
-    
-    numer = (2*imageEM)
-    denom = ((b_j**2 + 4*beta_j*imageEM)**0.5 + b_j)
-    
-    delta = 1e-6*abs(denom).max()
-    denom[denom < delta] = delta # avoid division by zero
-    
-    imageUpdated = numer/denom
-    
-    return imageUpdated
+    reconstructor = DePierroMAPEM(obj_fun, weights, beta, sensitivity_image, filter,
+                                  num_subsets=21, num_subiterations=21*10, mask=mask)
+    reconstructor.set_up(image)
+
+    # stop before 10 epochs once the image and penalised objective settle
+    # (Bowsher weights are asymmetric, so the objective test is a heuristic)
+    monitor = ConvergenceMonitor(rel_tol=1.0e-3, obj_tol=1.0e-6, objective_interval=2)
+    return reconstructor.run(monitor=monitor)
 
-def dePierroReg(image,weights):
-    
-    # get size and vectorise image for indexing 
-    imSize = image.shape
-    imageVec = image.reshape(-1,1,order='F').flatten('F')
-    
-    # get the neigbourhoods of each voxel
-    weightsSize = weights.shape
-    w = int(round(weightsSize[1]**(1.0/3))) # side length of neighbourhood
-    nhoodInd    = neighbourExtract(imSize,w)
-    nhoodIndVec = nhoodInd.reshape(-1,1,order='F').flatten('F')
-    
-    # retrieve voxel intensities for neighbourhoods 
-    resultVec = np.float32(imageVec[nhoodIndVec])
-    result = resultVec.reshape(nhoodInd.shape,order='F')
-    
-    # compute xreg
-    try:
-        imageReg = 0.5*np.sum(weights*(result + np.float32(image).reshape(-1,1,order='F')),axis=1)
-    except:
-        tmpVar = 1;    
-    imageReg = imageReg.reshape(imSize,order='F')
-    
-    return imageReg
-
-def neighbourExtract(imageSize,w):
-    # Adapted from Prior class        
-    n = imageSize[0]
-    m = imageSize[1]
-    h = imageSize[2]
-    wlen = 2*np.floor(w/2)
-    widx = xidx = yidx = np.arange(-wlen/2,wlen/2+1)
-
-    if h==1:
-        zidx = [0]
-        nN = w*w
-    else:
-        zidx = widx
-        nN = w*w*w
-        
-    Y,X,Z = np.meshgrid(np.arange(0,m), np.arange(0,n), np.arange(0,h))                
-    N = np.zeros([n*m*h, nN],dtype='int32')
-    l = 0
-    for x in xidx:
-        Xnew = setBoundary(X + x,n)
-        for y in yidx:
-            Ynew = setBoundary(Y + y,m)
-            for z in zidx:
-                Znew = setBoundary(Z + z,h)
-                N[:,l] = ((Xnew + (Ynew)*n + (Znew)*n*m)).reshape(-1,1).flatten('F')
-                l += 1
-    return N
-    
-def setBoundary(X,n):
-    # Boundary conditions for neighbourExtract
-    # Adapted from Prior class
-    idx = X<0
-    X[idx] = X[idx] + n
-    idx = X>n-1
-    X[idx] = X[idx] - n
-    return X.flatten('F')
 
 # %%
-import os
 import sys
 import matplotlib.pyplot as plt
-from pUtilities import show_2D_array
-from pSTIR import *
+from sirf.Utilities import show_2D_array
+from sirf.STIR import *
 import numpy as np
-import Prior as pr
+from sirf.contrib.kcl import Prior as pr
+from sirf.contrib.kcl.DePierroMAPEM import DePierroMAPEM, ConvergenceMonitor
+from sirf.contrib.kcl.weightStore import WeightStore
 
 data_path = '/media/sf_SIRF_data/sino_rawdata_100/'
 #data_path='/home/sirfuser/data/NEMA'
@@ -187,6 +79,9 @@ mr_file = 'my_data_MR_SIRF.hv'
 # output goes to files
 msg_red = MessageRedirector('info.txt', 'warn.txt', 'error.txt')
 
+# keep acquisition data in memory (no temporary files)
+AcquisitionData.set_storage_scheme('memory')
+
 acq_data = AcquisitionData(data_path + sino_file)
 
 #%%
@@ -284,12 +179,19 @@ sensitivity_image = obj_fun2.get_subset_sensitivity(0)
 
 # %% guided reconstruction
 
-# create a Prior for computing Bowsher weights
-myPrior = pr.Prior(sensitivity_image.as_array().shape)
-weights = myPrior.BowshserWeights(mr_array,7)
-weights = np.float32(weights/7.0)
+# the filter keeps the cylindrical field of view, so the prior and the
+# De Pierro update only work on the voxels inside it
+mask = pr.cylinderMask(sensitivity_image.as_array().shape)
+
+# create a Prior for computing Bowsher weights (float32, as the images);
+# they are only computed on the first run for this MR image and read from
+# the store afterwards
+myPrior = pr.Prior(sensitivity_image.as_array().shape, dtype='float32', mask=mask)
+store = WeightStore('weights')
+weights = store.get(myPrior, 'bowsher', mr_array, b=7, compact=True)
+weights = weights/7.0
 
-image_guided = my_dePierroMap(image, obj_fun, 50000, filter, weights, sensitivity_image)
+image_guided = my_dePierroMap(image, obj_fun, 50000, filter, weights, sensitivity_image, mask)
 image_array_guided = image_guided.as_array()
 show_2D_array('Reconstructed guided', image_array_guided[45,110:220,115:225])
 
@@ -297,7 +199,7 @@ image_guided.write('output_images/image_guided.v')
 
 ## %% OSEM reconstruction (beta = 0)
 #
-#image_OSEM = my_dePierroMap(image, obj_fun, 0, filter, weights, sensitivity_image)
+#image_OSEM = my_dePierroMap(image, obj_fun, 0, filter, weights, sensitivity_image, mask)
 #image_array_OSEM = image_OSEM.as_array()
 #show_2D_array('Reconstructed OSEM image', image_array_OSEM[45,110:220,115:225])
 #
@@ -306,10 +208,10 @@ image_guided.write('output_images/image_guided.v')
 ## %% unguided reconstruction
 #
 ## uniform weights
-#weights = np.ones([image.as_array().size,27],dtype='float')
-#weights = np.float32(weights/27.0)
+#weights = pr.CompactWeights.full(myPrior.nVoxels,27,dtype='float32')
+#weights = weights/27.0
 #
-#image_unguided = my_dePierroMap(image, obj_fun, 50000, filter, weights, sensitivity_image)
+#image_unguided = my_dePierroMap(image, obj_fun, 50000, filter, weights, sensitivity_image, mask)
 #image_array_unguided = image_unguided.as_array()
 #show_2D_array('Reconstructed unguided', image_array_unguided[45,110:220,115:225])
 #
@@ -0,0 +1,175 @@
+'''De Pierro MAPEM parameter sweep
+Reconstructs the noisy data of user_dePierroMap.py with De Pierro MAPEM for
+every combination of beta and weights (uniform, and Bowsher weights from a
+noise-free reconstruction for each b), in parallel worker processes. The
+acquisition model, objective function, sensitivity image and weights are set
+up once in each worker, which reads the noisy data and sensitivity image
+written by the script, and the weights from a weight store.
+
+Usage:
+  dePierroMap_sweep [--help | options]
+
+Options:
+  -f <file>, --file=<file>    raw data file
+                              [default: my_forward_projection.hs]
+  -p <path>, --path=<path>    path to data files, defaults to data/examples/PET
+                              subfolder of SIRF root folder
+  -s <subs>, --subs=<subs>    number of subsets [default: 12]
+  -i <siter>, --subiter=<siter>    number of sub-iterations [default: 24]
+  -b <betas>, --betas=<betas>  comma separated values of beta
+                              [default: 1000,5000,20000]
+  -n <nums>, --bowsher=<nums>  comma separated numbers of Bowsher neighbours
+                              [default: 5,10]
+  -w <wrks>, --workers=<wrks>  worker processes, defaults to one per
+                              reconstruction up to the number of CPUs
+  -t <thrs>, --threads=<thrs>  OpenMP threads per worker, defaults to the
+                              CPUs shared between the workers
+  -o <pref>, --output=<pref>  prefix of the output images, noisy data and
+                              sensitivity image [default: dePierro]
+  -d <dir>, --store=<dir>     directory of the weight store [default: weights]
+'''
+
+## CCP PETMR Synergistic Image Reconstruction Framework (SIRF)
+## Copyright 2015 - 2017 Rutherford Appleton Laboratory STFC
+## Copyright 2015 - 2017 University College London.
+##
+## This is software developed for the Collaborative Computational
+## Project in Positron Emission Tomography and Magnetic Resonance imaging
+## (http://www.ccppetmr.ac.uk/).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+##   you may not use this file except in compliance with the License.
+##   You may obtain a copy of the License at
+##       http://www.apache.org/licenses/LICENSE-2.0
+##   Unless required by applicable law or agreed to in writing, software
+##   distributed under the License is distributed on an "AS IS" BASIS,
+##   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##   See the License for the specific language governing permissions and
+##   limitations under the License.
+
+__version__ = '0.1.0'
+from docopt import docopt
+args = docopt(__doc__, version=__version__)
+
+import numpy as np
+
+from sirf.Utilities import existing_filepath, petmr_data_path
+from sirf.contrib.kcl import Prior as pr
+from sirf.contrib.kcl.DePierroMAPEM import DePierroMAPEM
+from sirf.contrib.kcl.dePierroSweep import DePierroSweep
+from sirf.contrib.kcl.weightStore import WeightStore
+import sirf.STIR as pet
+
+# process command-line options
+num_subsets = int(args['--subs'])
+num_subiterations = int(args['--subiter'])
+data_file = args['--file']
+data_path = args['--path']
+if data_path is None:
+    data_path = petmr_data_path('pet')
+raw_data_file = existing_filepath(data_path, data_file)
+betas = [float(beta) for beta in args['--betas'].split(',')]
+bowsher_numbers = [int(b) for b in args['--bowsher'].split(',')]
+num_workers = None if args['--workers'] is None else int(args['--workers'])
+threads_per_worker = None if args['--threads'] is None else int(args['--threads'])
+output_prefix = args['--output']
+store_dir = args['--store']
+
+
+def make_image(filter):
+
+    # create initial image estimate
+    image_size = (111, 111, 31)
+    voxel_size = (3, 3, 3.375) # voxel sizes are in mm
+    image = pet.ImageData()
+    image.initialise(image_size, voxel_size)
+    image.fill(1.0)
+    filter.apply(image)
+    return image
+
+def set_up_sweep(noisy_data_file, sensitivity_file):
+
+    # objective function, images and filter of the reconstructions of a
+    # worker process of the sweep
+    pet.AcquisitionData.set_storage_scheme('memory')
+    filter = pet.TruncateToCylinderProcessor()
+    image = make_image(filter)
+    obj_fun = pet.make_Poisson_loglikelihood(pet.AcquisitionData(noisy_data_file))
+    obj_fun.set_acquisition_model(pet.AcquisitionModelUsingRayTracingMatrix())
+    obj_fun.set_num_subsets(num_subsets)
+    obj_fun.set_up(image)
+    return obj_fun, pet.ImageData(sensitivity_file), image, filter
+
+def main():
+
+    # output goes to files
+    msg_red = pet.MessageRedirector('info.txt', 'warn.txt', 'errr.txt')
+
+    # keep acquisition data in memory (no temporary files)
+    pet.AcquisitionData.set_storage_scheme('memory')
+
+    # create acquisition model
+    acq_model = pet.AcquisitionModelUsingRayTracingMatrix()
+
+    # PET acquisition data to be read from the file specified by --file option
+    print('raw data: %s' % raw_data_file)
+    acq_data = pet.AcquisitionData(raw_data_file)
+
+    # Noisy data for testing, read by the workers of the sweep
+    noisy_data = acq_data.clone()
+    noisy_data.fill(np.random.poisson(acq_data.as_array()/10))
+    noisy_data_file = output_prefix + '_noisy.hs'
+    noisy_data.write(noisy_data_file)
+
+    # create filter that zeroes the image outside a cylinder of the same
+    # diameter as the image xy-section size
+    filter = pet.TruncateToCylinderProcessor()
+
+    # create initial image estimate
+    image = make_image(filter)
+
+    # sensitivity image for all data
+    obj_fun2 = pet.make_Poisson_loglikelihood(noisy_data)
+    obj_fun2.set_acquisition_model(acq_model)
+    obj_fun2.set_num_subsets(1)
+    obj_fun2.set_up(image)
+    sensitivity_image = obj_fun2.get_subset_sensitivity(0)
+    sensitivity_file = output_prefix + '_sensitivity.hv'
+    sensitivity_image.write(sensitivity_file)
+
+    # the prior and the De Pierro update only work on the field of view
+    mask = pr.cylinderMask(sensitivity_image.as_array().shape)
+    myPrior = pr.Prior(sensitivity_image.as_array().shape, dtype='float32', mask=mask)
+    weights = {'uniform': pr.CompactWeights.full(myPrior.nVoxels,27,dtype='float32')/27.0}
+
+    # noise free recon with beta = 0 for guidance
+    obj_fun3 = pet.make_Poisson_loglikelihood(acq_data)
+    obj_fun3.set_acquisition_model(acq_model)
+    reconstructor = DePierroMAPEM(obj_fun3, weights['uniform'], 0, sensitivity_image, filter,
+                                  num_subsets, num_subiterations, mask=mask)
+    reconstructor.set_up(image)
+    guidance = reconstructor.run(verbose=False).as_array()
+
+    for b in bowsher_numbers:
+        weights['bowsher%d' % b] = myPrior.BowshserWeights(guidance,b,compact=True)/float(b)
+
+    # all (beta, weights) combinations in parallel
+    sweep = DePierroSweep(set_up_sweep, (noisy_data_file, sensitivity_file), weights, betas,
+                          WeightStore(store_dir), num_workers=num_workers,
+                          threads_per_worker=threads_per_worker, num_subsets=num_subsets,
+                          num_subiterations=num_subiterations, mask=mask)
+    print('Running %d reconstructions on %d workers with %d threads each'
+          % (len(sweep.jobs), sweep.num_workers, sweep.threads_per_worker))
+    images = sweep.run()
+    sweep.write(images, image, output_prefix)
+
+# (the workers of the sweep import this script without running it)
+if __name__ == '__main__':
+    # if anything goes wrong, an exception will be thrown
+    # (cf. Error Handling section in the spec)
+    try:
+        main()
+        print('done')
+    except pet.error as err:
+        # display error information
+        print('%s' % err.value)
@@ -0,0 +1,134 @@
+'''Persistent store of prior weights
+Weights derived from guidance images (Bowsher, Gaussian or non-local) are
+saved as .npy files under a key hashed from the guidance array and everything
+else they depend on: the Prior geometry (image size, window, crop factor,
+boundary, mask, dtype), the kind of weights and their parameters. Later runs
+with the same inputs load them memory-mapped and read-only, so they cost no
+computation and several processes share the same pages. Weights computed
+otherwise (e.g. normalised) can be put in the store under a key hashed from
+their contents, for worker processes to load.
+'''
+
+## CCP PETMR Synergistic Image Reconstruction Framework (SIRF)
+## Copyright 2015 - 2017 Rutherford Appleton Laboratory STFC
+## Copyright 2015 - 2017 University College London.
+##
+## This is software developed for the Collaborative Computational
+## Project in Positron Emission Tomography and Magnetic Resonance imaging
+## (http://www.ccppetmr.ac.uk/).
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+##   you may not use this file except in compliance with the License.
+##   You may obtain a copy of the License at
+##       http://www.apache.org/licenses/LICENSE-2.0
+##   Unless required by applicable law or agreed to in writing, software
+##   distributed under the License is distributed on an "AS IS" BASIS,
+##   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##   See the License for the specific language governing permissions and
+##   limitations under the License.
+
+import hashlib
+import json
+import os
+import shutil
+import socket
+import numpy as np
+
+from .Prior import CompactWeights, SparseWeights
+
+
+class WeightStore(object):
+    # Directory of weights, one subdirectory per key holding meta.json and
+    # the arrays. Entries are written to a temporary directory and renamed,
+    # so concurrent writers of the same key are safe (the first one wins).
+    #
+    #   store = WeightStore('weights')
+    #   weights = store.get(prior, 'bowsher', mr_array, b=7, compact=True)
+    #   key = store.put(weights/7.0)    # store.load(key) in another process
+
+    builders = {'bowsher': 'BowshserWeights', 'gaussian': 'gaussianWeights',
+                'nonlocal': 'nonLocalWeights', 'multibowsher': 'multiChannelBowsherWeights'}
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, prior, kind, img, **params):
+        if kind not in self.builders:
+            raise ValueError("weights must be one of " + ", ".join(self.builders))
+        img = np.ascontiguousarray(img)
+        h = hashlib.sha256()
+        h.update(img.tobytes())
+        if prior.voxels is not None:
+            h.update(np.ascontiguousarray(prior.voxels).tobytes())
+        h.update(json.dumps([kind, img.shape, img.dtype.str, prior.imageSize, prior.sWindowSize,
+                             [float(c) for c in prior.imageCropFactor], prior.boundary,
+                             None if prior.dtype is None else prior.dtype.str,
+                             sorted(params.items())],
+                            default=lambda a: np.asarray(a).tolist()).encode())
+        return h.hexdigest()
+
+    def get(self, prior, kind, img, **params):
+        # weights of prior for guidance img, computed and saved if not stored
+        key = self.key(prior, kind, img, **params)
+        weights = self.load(key)
+        if weights is None:
+            self.save(key, getattr(prior, self.builders[kind])(img, **params))
+            weights = self.load(key)
+        return weights
+
+    def put(self, weights):
+        # key of weights hashed from their contents, saved if not stored
+        meta, arrays = self.__fields(weights)
+        h = hashlib.sha256()
+        h.update(json.dumps(meta, sort_keys=True).encode())
+        for name in sorted(arrays):
+            a = np.ascontiguousarray(arrays[name])
+            h.update(json.dumps([name, a.shape, a.dtype.str]).encode())
+            h.update(a.tobytes())
+        key = h.hexdigest()
+        if not os.path.isdir(os.path.join(self.directory, key)):
+            self.save(key, weights)
+        return key
+
+    def load(self, key):
+        path = os.path.join(self.directory, key)
+        if not os.path.isdir(path):
+            return None
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        def array(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        if meta['type']=='compact':
+            return CompactWeights(array('bits'), meta['nS'], meta['scale'], meta['dtype'])
+        if meta['type']=='sparse':
+            return SparseWeights(array('index'), array('values'), meta['nS'])
+        return array('weights')
+
+    def save(self, key, weights):
+        path = os.path.join(self.directory, key)
+        # unique to this writer, also across nodes sharing the directory
+        tmp = '%s.tmp-%s-%d' % (path, socket.gethostname(), os.getpid())
+        os.makedirs(tmp)
+        meta, arrays = self.__fields(weights)
+        for name, a in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), a)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # stored by another process meanwhile
+            shutil.rmtree(tmp)
+
+    def __fields(self, weights):
+        # meta data and arrays saved for weights
+        if isinstance(weights, CompactWeights):
+            meta = {'type': 'compact', 'nS': weights.nS, 'scale': float(weights.scale),
+                    'dtype': weights.dtype.str}
+            return meta, {'bits': weights.bits}
+        if isinstance(weights, SparseWeights):
+            return {'type': 'sparse', 'nS': weights.nS}, \
+                {'index': weights.index, 'values': weights.values}
+        return {'type': 'dense'}, {'weights': np.asarray(weights)}